@@ -0,0 +1,103 @@
+# 擬似データを使ったベンチマーク. 外付けディスクやPlanetScaleなしで各処理の速度を測る
+# 使い方 (srcディレクトリーで実行) : python benchmark.py --days 1 --legacy
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from satellite.aggregate import aggregate_minute_loop
+from satellite.charge import SAT_Charge
+from satellite.preprocess import Process_Binary_File
+from satellite.storage import read_day, save_columns
+from satellite.synthetic import Synthetic_Data
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db'))
+
+
+# funcの実行時間とピークメモリを測る
+def measure(name : str, func, rows : int) -> object:
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    st = time.perf_counter()
+    result = func()
+    duration = time.perf_counter() - st
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f'{name:<24}{duration:>10.3f} s{rows / duration:>14,.0f} rows/s{peak / 2**20:>10.1f} MB')
+    return result
+
+
+def main(days : int, index : int, events : int, chunk_min : int, legacy : bool, workdir : str):
+    sd = Synthetic_Data(seed=0)
+    pbf = Process_Binary_File()
+    sat = SAT_Charge()
+
+    # ローカルのSQLiteに書き込む. 接続先はsettingを読み込む時に決まるので、設定してから読み込む
+    os.environ['DATABASE_URL'] = f'sqlite:///{workdir}/benchmark.db'
+    import crud
+    from bulk import Bulk_Loader
+    from models import Base, Charge_Sat
+    Base.metadata.create_all(crud.ENGINE)
+
+    for day in range(days):
+        YMD = datetime(2010, 1, 1) + timedelta(days=day)
+        path = os.path.join(workdir, f'dmsp-f{index}_{YMD:%Y%m%d}')
+        truth = sd.save_day(path, index=index, events=events)
+        rows = os.path.getsize(path) // 2 // pbf.DELTA_MIN * 60
+        print(f'--- dmsp-f{index} {YMD:%Y/%m/%d} ({rows:,} rows, {len(truth)} charged rows)')
+
+        measure('read_binary_file', lambda: pbf.read_binary_file(path), rows)
+        df = measure('convert_DataFrame', lambda: pbf.convert_DataFrame(YMD=YMD, index=index), rows)
+        if legacy:
+            measure('convert_DataFrame_loop', lambda: pbf.convert_DataFrame_loop(YMD=YMD, index=index), rows)
+        measure('iter_chunks', lambda: sum(len(chunk) for chunk in pbf.iter_chunks(path, YMD=YMD, index=index, chunk_min=chunk_min)), rows)
+
+        sat.open_df(df)
+        charge_id = measure('detect_charge', sat.detect_charge, rows)
+        found = sorted(set((int(i), int(ch)) for i, ch in charge_id))
+        print(f'{"":<24}detected {len(found)} / {len(truth)} charged rows, exact match : {found == [(int(i), int(ch)) for i, ch in truth]}')
+
+        df['charge_channel'] = sat.get_charge_channel()
+        # 保存した1日分を、dateを含まない列だけでcsvと列指向フォーマットから読み直す
+        columns = ['mag_lat', 'mag_ltime', 'charge_channel']
+        csv_path, col_path = path + '.csv', path + '.col'
+        df.to_csv(csv_path, index=False)
+        save_columns(df, col_path)
+        csv_df = measure('read_day (csv)', lambda: read_day(csv_path, columns=columns), rows)
+        col_df = measure('read_day (col)', lambda: read_day(col_path, columns=columns), rows)
+        same = [list(d.columns) == columns and np.allclose(d.values, col_df.values.astype(float), atol=1e-4)
+                for d in (csv_df, df[columns].astype('float32'))]
+        print(f'{"":<24}read {columns}, match : {all(same)}')
+        os.remove(csv_path)
+        shutil.rmtree(col_path)
+        minute_df = measure('aggregate_minute', lambda: crud.aggregate_minute(df.set_index('date')), rows)
+        if legacy:
+            measure('aggregate_minute_loop', lambda: aggregate_minute_loop(df.set_index('date')), rows)
+        measure('InsertMinuteData', lambda: crud.InsertMinuteData(minute_df=minute_df, sta_index=index), len(minute_df))
+        # (satellite_id, date)はユニークなので、同じ日を入れ直す前に消す
+        with crud.ENGINE.begin() as conn:
+            conn.execute(Charge_Sat.__table__.delete())
+        with Bulk_Loader(engine=crud.ENGINE, verbose=False) as loader:
+            loader.add(minute_df, sta_index=index)
+            measure('Bulk_Loader', loader.flush, len(minute_df))
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--index', type=int, default=16, help='衛星番号')
+    parser.add_argument('--events', type=int, default=20, help='1日の帯電の回数')
+    parser.add_argument('--chunk-min', type=int, default=60)
+    parser.add_argument('--legacy', action='store_true', help='1行ずつ処理する旧実装も測る')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        main(days=args.days, index=args.index, events=args.events, chunk_min=args.chunk_min, legacy=args.legacy, workdir=workdir)
@@ -0,0 +1,371 @@
+# chargeテーブルへの一括挿入
+# 複数日分の1分ごとの集計結果を型付きの配列のまま溜めて、batch_size行ごとに1トランザクションで書き込む
+# use_infile=Trueの場合はcsvに書き出してLOAD DATA LOCAL INFILEで読み込ませる（MySQLのみ.
+# 接続時にconnect_argsでlocal_infile=1を指定し、サーバー側でもlocal_infileが有効である必要がある）
+# Bulk_Updaterは再計算したcharge_countを一時テーブルに入れて、(satellite_id, date)で結合した1回のUPDATEで反映する
+# Concurrent_Loaderは呼び出し側が次の日を読み込んで集計している間に、スレッドがバッチを並列に挿入する
+# rollup=Trueの場合は、書き込みと同じトランザクションで集計テーブル（rollup.py）も更新する
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from models import Charge_Sat
+from rollup import merge_ranges, refresh_month_ranges, refresh_rollups
+from setting import ENGINE
+from sqlalchemy import Column, DateTime, MetaData, SmallInteger, Table, text
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+# 挿入する列
+CHARGE_COLUMNS = ['satellite_id', 'date', 'lat', 'lon', 'charge_count']
+# 更新する値を入れる一時テーブル
+STAGING_TABLE = Table(
+    'charge_staging', MetaData(),
+    Column('satellite_id', SmallInteger, nullable=False),
+    Column('date', DateTime, nullable=False),
+    Column('charge_count', SmallInteger, nullable=False),
+    prefixes=['TEMPORARY'],
+)
+
+
+# DataFrameをexecutemanyに渡すdictのリストにする. 欠損値はNULLにする
+def to_records(df : pd.DataFrame, columns : list) -> list:
+    output = {}
+    for name in columns:
+        values = df[name].values
+        if values.dtype.kind == 'M':
+            values = values.astype('datetime64[us]')
+        output[name] = values.astype(object)
+        if values.dtype.kind == 'f':
+            output[name][np.isnan(values)] = None
+    return [dict(zip(columns, row)) for row in zip(*(output[name].tolist() for name in columns))]
+
+# 1分ごとの集計結果をchargeテーブルの列にする
+def to_charge_frame(minute_df : pd.DataFrame, sta_index : int) -> pd.DataFrame:
+    n = len(minute_df)
+    return pd.DataFrame({
+        'satellite_id' : np.full(n, sta_index, dtype=np.int64),
+        'date' : minute_df.index.values.astype('datetime64[s]'),
+        'lat' : minute_df['lat'].values.astype(float),
+        'lon' : minute_df['lon'].values.astype(float),
+        'charge_count' : minute_df['charge_count'].values.astype(np.int64),
+    })
+
+# やり直せば成功する可能性があるエラー（接続が切れた, ロックの待ち時間切れなど）
+def is_transient(error : Exception) -> bool:
+    return isinstance(error, OperationalError) or (isinstance(error, DBAPIError) and error.connection_invalidated)
+
+
+class Bulk_Loader():
+
+    def __init__(self, engine=ENGINE, batch_size : int = 100000, use_infile : bool = False, verbose : bool = True,
+                 rollup : bool = True) -> None:
+        if use_infile and engine.dialect.name != 'mysql':
+            raise ValueError(f'LOAD DATA LOCAL INFILEはMySQLでしか使えません: {engine.dialect.name}')
+        self.engine = engine
+        self.batch_size = batch_size
+        self.use_infile = use_infile
+        self.rollup = rollup
+        self.verbose = verbose
+        # 書き込み待ちの列と日
+        self.buffer = []
+        self.buffer_days = []
+        self.buffer_rows = 0
+        # 書き込んだ行数と時間
+        self.rows = 0
+        self.duration = 0.0
+        # 書き込めなかった日とエラー
+        self.failed = []
+
+    # 1分ごとの集計結果（indexがdate, 列がlat, lon, charge_count）を追加. batch_size行を超えたら書き込む
+    def add(self, minute_df : pd.DataFrame, sta_index : int, YMD=None) -> None:
+        n = len(minute_df)
+        if n == 0:
+            return
+        self.buffer.append(to_charge_frame(minute_df, sta_index))
+        self.buffer_days.append((sta_index, YMD))
+        self.buffer_rows += n
+        if self.buffer_rows >= self.batch_size:
+            self.flush()
+
+    # 溜まっている行を1トランザクションで書き込む. 失敗した時はバッチの日をfailedに記録して送出する
+    def flush(self) -> None:
+        if self.buffer_rows == 0:
+            return
+        df = pd.concat(self.buffer, ignore_index=True)
+        days = self.buffer_days
+        self.buffer = []
+        self.buffer_days = []
+        self.buffer_rows = 0
+
+        st = time.perf_counter()
+        try:
+            if self.use_infile:
+                self.load_infile(df)
+            else:
+                self.insert(df)
+        except Exception as e:
+            self.failed.extend((day, repr(e)) for day in days)
+            if self.verbose:
+                print(f'failed {days[0]} ~ {days[-1]} : {e!r}')
+            raise
+        duration = time.perf_counter() - st
+
+        self.rows += len(df)
+        self.duration += duration
+        if self.verbose:
+            print(f'{len(df):,} rows {duration:.1f}s ({len(df) / duration:,.0f} rows/s), total {self.rows:,} rows ({self.rows_per_sec():,.0f} rows/s)')
+
+    # executemanyで挿入
+    def insert(self, df : pd.DataFrame) -> None:
+        with self.engine.begin() as conn:
+            conn.execute(Charge_Sat.__table__.insert(), to_records(df, CHARGE_COLUMNS))
+            if self.rollup:
+                refresh_rollups(conn, df)
+
+    # csvに書き出してLOAD DATA LOCAL INFILEで読み込ませる
+    def load_infile(self, df : pd.DataFrame) -> None:
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            df[CHARGE_COLUMNS].to_csv(path, index=False, header=False, na_rep='\\N', date_format='%Y-%m-%d %H:%M:%S')
+            query = text(
+                f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE {Charge_Sat.__tablename__} "
+                "FIELDS TERMINATED BY ',' LINES TERMINATED BY '\\n' "
+                f"({', '.join(CHARGE_COLUMNS)})"
+            )
+            with self.engine.begin() as conn:
+                conn.execute(query)
+                if self.rollup:
+                    refresh_rollups(conn, df)
+        finally:
+            os.remove(path)
+
+    # 書き込みの速度
+    def rows_per_sec(self) -> float:
+        return self.rows / self.duration if self.duration > 0 else 0.0
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        # 例外の場合も、それまでに集計できた行は書き込む
+        self.close()
+
+
+class Bulk_Updater():
+
+    def __init__(self, engine=ENGINE, batch_size : int = 1000000, verbose : bool = True, rollup : bool = True) -> None:
+        self.engine = engine
+        self.batch_size = batch_size
+        self.verbose = verbose
+        self.rollup = rollup
+        self.buffer = []
+        self.buffer_days = []
+        self.buffer_rows = 0
+        # 送った行数, 更新された行数と時間
+        self.rows = 0
+        self.updated = 0
+        self.duration = 0.0
+        # 反映できなかった日とエラー
+        self.failed = []
+
+    # 1分ごとの集計結果（indexがdate, 列にcharge_countを含む）を追加. batch_size行を超えたら反映する
+    def add(self, minute_df : pd.DataFrame, sta_index : int, YMD=None) -> None:
+        n = len(minute_df)
+        if n == 0:
+            return
+        self.buffer.append(pd.DataFrame({
+            'satellite_id' : np.full(n, sta_index, dtype=np.int64),
+            'date' : minute_df.index.values.astype('datetime64[s]'),
+            'charge_count' : minute_df['charge_count'].values.astype(np.int64),
+        }))
+        self.buffer_days.append((sta_index, YMD))
+        self.buffer_rows += n
+        if self.buffer_rows >= self.batch_size:
+            self.flush()
+
+    # 一時テーブルと結合して更新する文. MySQLはUPDATE ... JOIN, その他はUPDATE ... FROM
+    def get_update_query(self):
+        table = Charge_Sat.__tablename__
+        staging = STAGING_TABLE.name
+        if self.engine.dialect.name == 'mysql':
+            return text(
+                f'UPDATE {table} JOIN {staging} ON {table}.satellite_id = {staging}.satellite_id AND {table}.date = {staging}.date '
+                f'SET {table}.charge_count = {staging}.charge_count'
+            )
+        return text(
+            f'UPDATE {table} SET charge_count = {staging}.charge_count FROM {staging} '
+            f'WHERE {table}.satellite_id = {staging}.satellite_id AND {table}.date = {staging}.date'
+        )
+
+    # 溜まっている値を一時テーブルに入れて、1トランザクションで反映する. 失敗した時はバッチの日をfailedに記録して送出する
+    def flush(self) -> None:
+        if self.buffer_rows == 0:
+            return
+        df = pd.concat(self.buffer, ignore_index=True)
+        days = self.buffer_days
+        self.buffer = []
+        self.buffer_days = []
+        self.buffer_rows = 0
+
+        st = time.perf_counter()
+        with self.engine.connect() as conn:
+            try:
+                with conn.begin():
+                    STAGING_TABLE.create(conn)
+                    conn.execute(STAGING_TABLE.insert(), to_records(df, [c.name for c in STAGING_TABLE.columns]))
+                    updated = conn.execute(self.get_update_query()).rowcount
+                    STAGING_TABLE.drop(conn)
+                    if self.rollup:
+                        refresh_rollups(conn, df)
+            except Exception as e:
+                # 一時テーブルが残った接続をプールに戻さない
+                conn.invalidate()
+                self.failed.extend((day, repr(e)) for day in days)
+                if self.verbose:
+                    print(f'failed {days[0]} ~ {days[-1]} : {e!r}')
+                raise
+        duration = time.perf_counter() - st
+
+        self.rows += len(df)
+        self.updated += updated
+        self.duration += duration
+        if self.verbose:
+            print(f'{len(df):,} rows {duration:.1f}s ({len(df) / duration:,.0f} rows/s), {updated:,} rows updated')
+
+    def rows_per_sec(self) -> float:
+        return self.rows / self.duration if self.duration > 0 else 0.0
+
+    def close(self) -> None:
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+class Concurrent_Loader():
+
+    def __init__(self, engine=ENGINE, workers : int = 4, batch_size : int = 100000, queue_size : int = None,
+                 retries : int = 3, verbose : bool = True, rollup : bool = True) -> None:
+        """""
+        workers : 挿入するスレッド数. エンジンのpool_size + max_overflow以下にする
+        queue_size : 挿入待ちのバッチ数の上限. いっぱいの時はaddが待つ. Noneの場合はworkersの2倍
+        retries : 一時的なエラーの時に同じバッチをやり直す回数
+        """""
+        self.engine = engine
+        self.batch_size = batch_size
+        self.retries = retries
+        self.verbose = verbose
+        self.rollup = rollup
+        # 1時間・1日の集計を更新した範囲. 1か月の集計はスレッド間で重なるのでcloseでまとめて更新する
+        self.rollup_ranges = {}
+        self.queue = queue.Queue(maxsize=queue_size or 2 * workers)
+        self.buffer = []
+        self.buffer_days = []
+        self.buffer_rows = 0
+        # スレッドごとの挿入した行数, 時間, やり直した回数
+        self.stats = [{'rows' : 0, 'duration' : 0.0, 'batches' : 0, 'retries' : 0} for _ in range(workers)]
+        # 挿入できなかった日とエラー
+        self.failed = []
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.work, args=(i,), daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    # 1日分の集計結果を追加. batch_size行を超えたら挿入待ちに入れる
+    def add(self, minute_df : pd.DataFrame, sta_index : int, YMD=None) -> None:
+        if len(minute_df) == 0:
+            return
+        self.buffer.append(to_charge_frame(minute_df, sta_index))
+        self.buffer_days.append((sta_index, YMD))
+        self.buffer_rows += len(minute_df)
+        if self.buffer_rows >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer_rows == 0:
+            return
+        self.queue.put((self.buffer_days, pd.concat(self.buffer, ignore_index=True)))
+        self.buffer = []
+        self.buffer_days = []
+        self.buffer_rows = 0
+
+    # 1バッチを1トランザクションで挿入. 一時的なエラーはretries回までやり直す
+    def insert(self, i : int, df : pd.DataFrame) -> None:
+        records = to_records(df, CHARGE_COLUMNS)
+        for attempt in range(self.retries + 1):
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(Charge_Sat.__table__.insert(), records)
+                    if self.rollup:
+                        ranges = refresh_rollups(conn, df, months=False)
+                if self.rollup:
+                    with self.lock:
+                        self.rollup_ranges = merge_ranges(self.rollup_ranges, ranges)
+                return
+            except DBAPIError as e:
+                if attempt == self.retries or not is_transient(e):
+                    raise
+                self.stats[i]['retries'] += 1
+                time.sleep(2 ** attempt)
+
+    # スレッドの処理. Noneを受け取るまでバッチを挿入する
+    def work(self, i : int) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            days, df = item
+            st = time.perf_counter()
+            try:
+                self.insert(i, df)
+                self.stats[i]['rows'] += len(df)
+                self.stats[i]['batches'] += 1
+            except Exception as e:
+                with self.lock:
+                    self.failed.extend((day, repr(e)) for day in days)
+                if self.verbose:
+                    print(f'worker {i} failed {days[0]} ~ {days[-1]} : {e!r}')
+            finally:
+                self.stats[i]['duration'] += time.perf_counter() - st
+                self.queue.task_done()
+
+    # 残りを挿入して全てのスレッドの終了を待つ
+    def close(self) -> None:
+        self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.rollup and self.rollup_ranges:
+            with self.engine.begin() as conn:
+                refresh_month_ranges(conn, self.rollup_ranges)
+        if self.verbose:
+            self.report()
+
+    # スレッドごとの速度
+    def report(self) -> None:
+        for i, stat in enumerate(self.stats):
+            speed = stat['rows'] / stat['duration'] if stat['duration'] > 0 else 0.0
+            print(f"worker {i} : {stat['rows']:,} rows, {stat['batches']} batches, {stat['retries']} retries, {speed:,.0f} rows/s")
+        print(f'failed : {len(self.failed)} days')
+
+    def rows_per_sec(self) -> float:
+        return sum(stat['rows'] / stat['duration'] for stat in self.stats if stat['duration'] > 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
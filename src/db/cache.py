@@ -0,0 +1,143 @@
+# crudの読み込み関数の結果をローカルのディスクにキャッシュする
+# キーは (関数名, 引数) で、衛星ごとの透かし（行数, 最大のid）が変わった時に無効になる
+# 合計サイズがmax_bytesを超えたら、最後に使ってから長い順に削除する
+#     <cache_dir>/<key>.npz   結果のDataFrameの列
+#     <cache_dir>/<key>.json  関数名, 引数, 透かし
+# 他のマシンからのUPDATEは行数と最大のidを変えないので検知できない. このマシンのUpdateChargeCountはclearを呼ぶ
+import functools
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from models import Charge_Sat
+from setting import ENGINE
+from sqlalchemy import func, select
+
+QUERY_CACHE_DIR = os.getenv("DB_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "satellite-database"))
+QUERY_CACHE_BYTES = int(os.getenv("DB_CACHE_BYTES", str(2 * 1024**3)))
+QUERY_CACHE_ENABLED = os.getenv("DB_CACHE", "1") == "1"
+
+
+class Query_Cache():
+
+    def __init__(self, cache_dir : str = QUERY_CACHE_DIR, max_bytes : int = QUERY_CACHE_BYTES,
+                 engine=ENGINE, enabled : bool = QUERY_CACHE_ENABLED) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.engine = engine
+        self.enabled = enabled
+
+    # 衛星ごとの透かし [[衛星番号, 行数, 最大のid], ...]. (satellite_id, date)のインデックスだけで求まる
+    def get_watermark(self, satellites : list) -> list:
+        table = Charge_Sat.__table__
+        query = select(table.c.satellite_id, func.count(), func.max(table.c.id)).where(
+            table.c.satellite_id.in_(satellites)
+        ).group_by(table.c.satellite_id)
+        with self.engine.connect() as conn:
+            rows = {row[0] : [int(row[0]), int(row[1]), int(row[2])] for row in conn.execute(query)}
+        return [rows.get(sat, [int(sat), 0, 0]) for sat in sorted(satellites)]
+
+    def get_key(self, name : str, arguments : dict) -> str:
+        text = json.dumps([name, arguments], sort_keys=True, default=str)
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    def get_path(self, key : str, ext : str) -> str:
+        return os.path.join(self.cache_dir, key + ext)
+
+    # キャッシュを読み込む. ない場合や透かしが変わった場合はNone
+    def get(self, key : str, watermark : list) -> pd.DataFrame:
+        meta_path = self.get_path(key, '.json')
+        data_path = self.get_path(key, '.npz')
+        if not (os.path.isfile(meta_path) and os.path.isfile(data_path)):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['watermark'] != watermark:
+            self.remove(key)
+            return None
+        try:
+            with np.load(data_path) as data:
+                df = pd.DataFrame({name : data[name] for name in meta['columns']}, columns=meta['columns'])
+        except ValueError:
+            # object型の列が入っている（以前のバージョンで書き込んだ）キャッシュは読めないので削除する
+            self.remove(key)
+            return None
+        # 最後に使った時刻を更新する（LRU）
+        os.utime(data_path)
+        return df
+
+    # キャッシュを書き込む. 一時ファイルから置き換えるので、書き込み途中のファイルは読まれない
+    # object型の列はpickleしないと保存できず、allow_pickle=Falseでは読めないのでキャッシュしない. 書き込んだかを返す
+    def put(self, key : str, name : str, arguments : dict, watermark : list, df : pd.DataFrame) -> bool:
+        arrays = {str(column) : np.asarray(df[column].values) for column in df.columns}
+        if any(values.dtype.hasobject for values in arrays.values()):
+            return False
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data_path = self.get_path(key, '.npz')
+        meta_path = self.get_path(key, '.json')
+        tmp_path = data_path + '.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, data_path)
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'function' : name, 'arguments' : arguments, 'watermark' : watermark,
+                       'columns' : [str(column) for column in df.columns]}, f, default=str)
+        os.replace(meta_path + '.tmp', meta_path)
+        self.evict()
+        return True
+
+    def remove(self, key : str) -> None:
+        for ext in ('.npz', '.json'):
+            if os.path.exists(self.get_path(key, ext)):
+                os.remove(self.get_path(key, ext))
+
+    # 合計サイズがmax_bytes以下になるまで、最後に使った時刻が古い順に削除する
+    def evict(self) -> None:
+        entries = []
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.npz') and not file.endswith('.tmp.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, file))
+                entries.append((stat.st_mtime, stat.st_size, file[:-len('.npz')]))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+
+    # satellite_idを含むキャッシュを削除. Noneの場合は全て削除する
+    def clear(self, satellite_id : int = None) -> None:
+        if not os.path.isdir(self.cache_dir):
+            return
+        for file in os.listdir(self.cache_dir):
+            if not file.endswith('.json'):
+                continue
+            key = file[:-len('.json')]
+            with open(self.get_path(key, '.json')) as f:
+                meta = json.load(f)
+            if satellite_id is None or satellite_id in [w[0] for w in meta['watermark']]:
+                self.remove(key)
+
+    # DataFrameを返す関数をキャッシュするデコレーター. satellite_idの引数（整数またはリスト）の衛星で透かしを取る
+    def cached(self, function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return function(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            satellites = [int(sat) for sat in np.atleast_1d(arguments['satellite_id'])]
+
+            key = self.get_key(function.__name__, arguments)
+            watermark = self.get_watermark(satellites)
+            df = self.get(key, watermark)
+            if df is None:
+                df = function(*args, **kwargs)
+                self.put(key, function.__name__, arguments, watermark, df)
+            return df
+        return wrapper
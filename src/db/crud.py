@@ -1,66 +1,237 @@
+import os
+import sys
+import time
 from datetime import datetime
-from typing import Tuple
+from typing import Callable, Iterator, Tuple
 
 import numpy as np
 import pandas as pd
+from bulk import Bulk_Loader, Bulk_Updater, Concurrent_Loader, is_transient
+from cache import Query_Cache
 from models import Charge_Sat
+from rollup import LEVELS, ROLLUP_COLUMNS, choose_level, floor_date, refresh_rollups
 from setting import ENGINE, session
-from sqlalchemy import func, or_
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import DBAPIError
 
+# satelliteパッケージを読み込めるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from satellite.aggregate import aggregate_minute
+from satellite.executor import get_days
+from satellite.label import HORIZONS, get_label_name, iter_next_charge_labels
+from satellite.pipeline import run_day
+from satellite.storage import COLUMN_EXTENSION, Column_Writer, find_processed_path, read_day
 
-def charge_count(channel_array):
-    count = 0
-    for ch in channel_array:
-        if ch > 0:
-            count += 1
-    return count
+# 1分ごとの集計に使う列
+MINUTE_COLUMNS = ['date', 'mag_lat', 'mag_ltime', 'charge_channel']
+# 1~10分後のcharge_countの列
+NEXT_COLUMNS = ['one_minute_after', 'two_minute_after', 'three_minute_after', 'four_minute_after', 'five_minute_after',
+                'six_minute_after', 'seven_minute_after', 'eight_minute_after', 'nine_minute_after', 'ten_minute_after']
+# 読み込み関数の結果のキャッシュ
+QUERY_CACHE = Query_Cache(engine=ENGINE)
 
-# 1つのcsvをデータベースに挿入
-def InsertChargeData(path : str, sta_index : int) -> None:
-    # ローカルのデータを読み込み
-    df = pd.read_csv(path, parse_dates=['date'])
-    df.set_index('date', inplace=True)
-    # 1分ごとに集計
-    charge_count_array = df.charge_channel.resample('MIN').apply(charge_count)
-    mag_lat_array = df.mag_lat.resample('MIN').first().values
-    mag_ltime_array = df.mag_ltime.resample('MIN').first().values
-    date = charge_count_array.index.to_pydatetime()
-    charge_count_array = charge_count_array.values
+
+# 1分ごとの集計結果をデータベースに挿入
+def InsertMinuteData(minute_df : pd.DataFrame, sta_index : int) -> None:
+    date = minute_df.index.to_pydatetime()
     sat_id = [sta_index] * len(date)
     # データフレーム化
     columns = ['satellite_id', 'date', 'lat', 'lon', 'charge_count']
-    output_df = pd.DataFrame(np.array([sat_id, date, mag_lat_array, mag_ltime_array, charge_count_array]).T, columns=columns)
-    output_df["created_at"] = datetime.now()
-    # データベースへ書き込み
-    output_df.to_sql("charge",con=ENGINE, if_exists="append", method="multi", index=False)
+    output_df = pd.DataFrame(np.array([sat_id, date, minute_df.lat.values, minute_df.lon.values, minute_df.charge_count.values]).T, columns=columns)
+    # データベースへ書き込み. 集計テーブルの更新と同じトランザクションにして、失敗した時はどちらも書き込まない
+    with ENGINE.begin() as conn:
+        output_df.to_sql("charge",con=conn, if_exists="append", method="multi", index=False)
+        refresh_rollups(conn, pd.DataFrame({'satellite_id' : sat_id, 'date' : minute_df.index.values}))
+
+# 1日分のファイル（csv, 列指向フォーマット）をデータベースに挿入
+def InsertChargeData(path : str, sta_index : int) -> None:
+    # ローカルのデータを読み込み. 集計に使う列だけを読む
+    df = read_day(path, columns=MINUTE_COLUMNS)
+    df.set_index('date', inplace=True)
+    # 1分ごとに集計
+    minute_df = aggregate_minute(df)
+    InsertMinuteData(minute_df=minute_df, sta_index=sta_index)
+
 
+# 期間内の処理済みデータ (日付, パス) を順に返す. extのファイルがない日はcsvを使い、どちらもない日は数えて最後に表示する
+def iter_processed_paths(sat_index : int, start_year : int, end_year : int, ext : str = COLUMN_EXTENSION) -> Iterator[Tuple[datetime, str]]:
+    missing = 0
+    for YMD in get_days(datetime(start_year, 1, 1), datetime(end_year, 12, 31)):
+        path = find_processed_path(index=sat_index, YMD=YMD, ext=ext)
+        if path is None:
+            missing += 1
+            continue
+        yield YMD, path
+    if missing > 0:
+        print(f'dmsp-f{sat_index} {start_year}~{end_year} : ファイルがない日 {missing} 日')
 
 # 一定期間のファイルをデータベースに挿入
-def InsertAll(sat_index : int, start_year : int, end_year : int) -> None:
-    for year in range(start_year, end_year+1):
-        for month in range(1, 13):
-            for day in range(1, 32):
-
-                month_str = str(month).zfill(2)
-                day_str = str(day).zfill(2)
-                path = f'/Volumes/USB/Processed_Data/dmsp-f{sat_index}/{year}/{month_str}/dmsp-f{sat_index}_{year}{month_str}{day_str}.csv'
-
-                # データベースに挿入
-                try :
-                    InsertChargeData(path=path, sta_index=sat_index)
-                    print(year, month, day)
-                except:
+def InsertAll(sat_index : int, start_year : int, end_year : int, ext : str = COLUMN_EXTENSION) -> None:
+    for YMD, path in iter_processed_paths(sat_index, start_year, end_year, ext=ext):
+        # データベースに挿入
+        try :
+            InsertChargeData(path=path, sta_index=sat_index)
+            print(YMD.year, YMD.month, YMD.day)
+        except Exception as e:
+            print(f'{YMD:%Y/%m/%d} failed : {e!r}')
+            continue
+
+# 衛星の期間内で、既にchargeテーブルにある日
+def get_loaded_days(sat_index : int, start_year : int, end_year : int) -> set:
+    table = Charge_Sat.__table__
+    query = select(func.date(table.c.date)).where(
+        table.c.satellite_id == sat_index,
+        table.c.date >= datetime(start_year, 1, 1),
+        table.c.date < datetime(end_year + 1, 1, 1),
+    ).group_by(func.date(table.c.date))
+    with ENGINE.connect() as conn:
+        days = [row[0] for row in conn.execute(query)]
+    return set(pd.to_datetime(days).to_pydatetime()) if days else set()
+
+# 複数の衛星・一定期間のファイルをまとめてデータベースに挿入
+def InsertAllBulk(sat_index_list : list, start_year : int, end_year : int, ext : str = COLUMN_EXTENSION,
+                  batch_size : int = 100000, use_infile : bool = False) -> list:
+    """""
+    batch_size : 1トランザクションで挿入する行数, use_infile : LOAD DATA LOCAL INFILEを使う
+    バッチは日の単位で書き込まれ、既にデータベースにある日は飛ばすので、途中で止まった時は同じ期間でやり直せる
+    返り値 : 挿入できなかった日 (衛星番号, 日付) とエラーのリスト
+    """""
+    failed = []
+    with Bulk_Loader(engine=ENGINE, batch_size=batch_size, use_infile=use_infile) as loader:
+        for sat_index in sat_index_list:
+            loaded = get_loaded_days(sat_index, start_year, end_year)
+            for YMD, path in iter_processed_paths(sat_index, start_year, end_year, ext=ext):
+                if YMD in loaded:
+                    continue
+                try:
+                    minute_df = aggregate_minute(read_day(path, columns=MINUTE_COLUMNS).set_index('date'))
+                except Exception as e:
+                    print(f'dmsp-f{sat_index} {YMD:%Y/%m/%d} failed : {e!r}')
+                    failed.append(((sat_index, YMD), repr(e)))
                     continue
-            
-# 帯電しているデータを取得
-def ReadChargeDate():
-    # SELECT
-    sat_data = session.query(Charge_Sat).filter(Charge_Sat.charge_count > 0)
-    tmp = []
-    for sat in sat_data:
-        tmp.append([sat.date, sat.lat, sat.lon, sat.charge_count])
-    df = pd.DataFrame(tmp, columns=['date', 'lat', 'lon', 'charge_count'])
-    df.to_csv('charge.csv', index=False)
+                try:
+                    loader.add(minute_df, sta_index=sat_index, YMD=YMD)
+                except Exception:
+                    # 書き込めなかったバッチの日はloader.failedに記録されている
+                    continue
+        try:
+            loader.flush()
+        except Exception:
+            pass
+    print(f'{loader.rows:,} rows ({loader.rows_per_sec():,.0f} rows/s), failed : {len(failed) + len(loader.failed)} days')
+    return failed + loader.failed
+
+# 複数の衛星・一定期間のファイルを、読み込みと挿入を並行してデータベースに挿入
+def InsertAllConcurrent(sat_index_list : list, start_year : int, end_year : int, ext : str = COLUMN_EXTENSION,
+                        workers : int = 4, batch_size : int = 20000, queue_size : int = None, retries : int = 3) -> list:
+    """""
+    workers : 挿入するスレッド数, batch_size : 1トランザクションで挿入する行数
+    queue_size : 挿入待ちのバッチ数の上限, retries : 一時的なエラーの時にバッチをやり直す回数
+    返り値 : 挿入できなかった日 (衛星番号, 日付) とエラーのリスト
+    """""
+    failed = []
+    with Concurrent_Loader(engine=ENGINE, workers=workers, batch_size=batch_size, queue_size=queue_size, retries=retries) as loader:
+        for sat_index in sat_index_list:
+            for YMD, path in iter_processed_paths(sat_index, start_year, end_year, ext=ext):
+                try:
+                    df = read_day(path, columns=MINUTE_COLUMNS).set_index('date')
+                except Exception as e:
+                    failed.append(((sat_index, YMD), repr(e)))
+                    continue
+                loader.add(aggregate_minute(df), sta_index=sat_index, YMD=YMD)
+    return failed + loader.failed
+
+# 生データから1分ごとの集計までを1回で処理してデータベースに挿入
+def InsertFromRaw(sat_index : int, start_year : int, end_year : int, save : bool = False) -> None:
+    """""
+    save : Trueの場合は1秒ごとのデータも列指向フォーマットで保存する
+    """""
+    for YMD in get_days(datetime(start_year, 1, 1), datetime(end_year, 12, 31)):
+        try :
+            minute_df = run_day(index=sat_index, YMD=YMD, save=save)
+        except FileNotFoundError:
+            continue
+        InsertMinuteData(minute_df=minute_df, sta_index=sat_index)
+        print(YMD.year, YMD.month, YMD.day)
+
+# chargeテーブルの行をchunk_size行ずつDataFrameで取得. ORMのオブジェクトは作らない
+def IterChargeRows(columns : list = None, satellite_id : int = None, start : datetime = None, end : datetime = None,
+                   charged_only : bool = False, chunk_size : int = 100000) -> Iterator[pd.DataFrame]:
+    """""
+    columns : 取得する列. Noneの場合は全ての列
+    satellite_id : 衛星番号, start, end : 期間 [start, end), charged_only : 帯電している行だけ
+    """""
+    table = Charge_Sat.__table__
+    if columns is None:
+        columns = [c.name for c in table.columns]
+    query = select(*[table.c[name] for name in columns])
+    if satellite_id is not None:
+        query = query.where(table.c.satellite_id == satellite_id)
+    if start is not None:
+        query = query.where(table.c.date >= start)
+    if end is not None:
+        query = query.where(table.c.date < end)
+    if charged_only:
+        query = query.where(table.c.charge_count > 0)
+    query = query.order_by(table.c.satellite_id, table.c.date)
+
+    # サーバー側のカーソルでchunk_size行ずつ読む
+    with ENGINE.connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(query)
+        for rows in result.partitions(chunk_size):
+            df = pd.DataFrame(rows, columns=columns)
+            for name in columns:
+                if name == 'date':
+                    df[name] = pd.to_datetime(df[name])
+                else:
+                    df[name] = pd.to_numeric(df[name])
+            yield df
+
+# 帯電しているデータをcsvに書き込む
+def ReadChargeDate(path : str = 'charge.csv', chunk_size : int = 100000) -> None:
+    header = True
+    for df in IterChargeRows(columns=['date', 'lat', 'lon', 'charge_count'], charged_only=True, chunk_size=chunk_size):
+        df.to_csv(path, index=False, header=header, mode='w' if header else 'a')
+        header = False
+
+# chargeテーブルを列指向フォーマット（.col）に書き出す. 返り値は書き出した行数
+def ExportChargeData(path : str, columns : list = None, satellite_id : int = None, start : datetime = None,
+                     end : datetime = None, charged_only : bool = False, chunk_size : int = 100000) -> int:
+    with Column_Writer(path) as writer:
+        for df in IterChargeRows(columns=columns, satellite_id=satellite_id, start=start, end=end,
+                                 charged_only=charged_only, chunk_size=chunk_size):
+            writer.write(df)
+    return writer.length
+
+# 衛星ごとの [start, end) の帯電の集計を取得
+def GetChargeSummary(satellite_id, start : datetime, end : datetime, freq : str = None,
+                     by_sector : bool = False) -> pd.DataFrame:
+    """""
+    satellite_id : 衛星番号またはそのリスト, start, end : 期間（1時間単位）
+    freq : 'hour', 'day', 'month'の場合はその単位ごと, Noneの場合は期間全体
+    by_sector : Trueの場合は地磁気地方時の区分ごと
+    返り値 : charged_minutes, total_minutes, charge_seconds, rate（帯電している分数の割合）
+    """""
+    _, model, _ = choose_level(start, end, freq)
+    table = model.__table__
+    satellites = [int(sat) for sat in np.atleast_1d(satellite_id)]
+    query = select(*[table.c[name] for name in ROLLUP_COLUMNS]).where(
+        table.c.satellite_id.in_(satellites), table.c.start >= start, table.c.start < end,
+    )
+    with ENGINE.connect() as conn:
+        df = pd.DataFrame(conn.execute(query).all(), columns=ROLLUP_COLUMNS)
+
+    keys = ['satellite_id']
+    if freq is not None:
+        unit = dict((name, unit) for name, _, unit in LEVELS)[freq]
+        df['start'] = floor_date(pd.to_datetime(df['start']).values, unit) if len(df) else df['start']
+        keys.append('start')
+    if by_sector:
+        keys.append('mlt_sector')
+    output = df.groupby(keys, as_index=False)[['charged_minutes', 'total_minutes', 'charge_seconds']].sum()
+    output['rate'] = output['charged_minutes'] / output['total_minutes']
+    return output
+
 
 # 時刻に対応するidを取得
 def get_date_id(satellite_id, YMD : datetime) -> int:
@@ -120,103 +291,248 @@ def get_charge_next(start_id: int, end_id : int) -> Tuple[list, int]:
     next_ind = end_id + 1
     return output, next_ind
 
-# 任意の衛星の帯電データを全て取得
-def GetChargeDataBySatellite(satellite_id : int) -> list:
-    start_id = session.query(Charge_Sat.id).filter(
-        Charge_Sat.satellite_id == satellite_id
-    ).first()[0]
-
-    last_id = session.query(Charge_Sat.id).filter(
-        Charge_Sat.satellite_id == satellite_id
-        ).order_by(
-        Charge_Sat.id.desc()
-        ).first()[0]
-    
-    output = []
-    while start_id < last_id:
-        # 取得期間
-        end_id = start_id + 100000 # 1度に100,000レコードしか取得できないため
-        if end_id >= last_id:
-            end_id = last_id
-        # 10万レコードから探索
+# 1~10分後のどこかで帯電しているレコードを、日付順にbatch_size行ずつ取得するクエリー
+def charge_next_query(satellite_id : int, last_date : datetime, batch_size : int):
+    """""
+    leadが窓の端で欠けないように、batch_size行の後ろに10行を重ねて読み、leadを求めてからbatch_size行目までを返す
+    返す範囲の最後の行は帯電していなくても返す（次のバッチの開始位置と読んだ行数に使う）
+    """""
+    overlap = len(NEXT_COLUMNS)
+    conditions = [Charge_Sat.satellite_id == satellite_id]
+    if last_date is not None:
+        conditions.append(Charge_Sat.date > last_date)
+    # 開始位置から batch_size + 10 行
+    window = select(
+        Charge_Sat.satellite_id,
+        Charge_Sat.date,
+        Charge_Sat.lat,
+        Charge_Sat.lon,
+        Charge_Sat.charge_count,
+    ).where(*conditions).order_by(Charge_Sat.date).limit(batch_size + overlap).subquery('window')
+
+    # 衛星ごとのlead
+    leads = [
+        func.lead(window.c.charge_count, i + 1).over(partition_by=window.c.satellite_id, order_by=window.c.date).label(name)
+        for i, name in enumerate(NEXT_COLUMNS)
+    ]
+    sub = select(
+        *window.c,
+        *leads,
+        func.row_number().over(order_by=window.c.date).label('row_number'),
+        func.count().over().label('window_rows'),
+    ).subquery('sub')
+
+    return select(sub).where(
+        sub.c.row_number <= batch_size,
+        or_(sub.c.row_number == batch_size, sub.c.row_number == sub.c.window_rows, *[sub.c[name] > 0 for name in NEXT_COLUMNS]),
+    ).order_by(sub.c.date)
+
+# 一時的なエラー（接続が切れた等）の時はretries回までやり直してクエリーを実行. それ以外のエラーはすぐに送出する
+def execute_with_retry(query, retries : int = 3) -> list:
+    for attempt in range(retries + 1):
         try:
-            print(start_id, end_id)
-            tmp, start_id = get_charge_next(start_id=start_id, end_id=end_id)
-            output.extend(tmp)
-        except :
-            continue
+            with ENGINE.connect() as conn:
+                return conn.execute(query).all()
+        except DBAPIError as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            time.sleep(2 ** attempt)
 
-    return output
+# 取得した行を列ごとの配列にする. 存在しない（データの最後より後の）leadは-1
+def to_charge_next_batch(rows : list) -> dict:
+    columns = list(zip(*rows)) if rows else [[] for _ in range(5 + len(NEXT_COLUMNS))]
+    batch = {
+        'satellite_id' : np.array(columns[0], dtype=np.int16),
+        'date' : np.array(columns[1], dtype='datetime64[ns]'),
+        'lat' : np.array(columns[2], dtype=np.float32),
+        'lon' : np.array(columns[3], dtype=np.float32),
+        'charge_count' : np.array(columns[4], dtype=np.int16),
+    }
+    for name, values in zip(NEXT_COLUMNS, columns[5:]):
+        batch[name] = np.array([-1 if v is None else v for v in values], dtype=np.int16)
+    return batch
+
+# 任意の衛星の帯電データを列ごとの配列のバッチで順に取得
+def IterChargeDataBySatellite(satellite_id : int, batch_size : int = 100000, retries : int = 3,
+                              progress : Callable = None) -> Iterator[dict]:
+    """""
+    batch_size : 1回のクエリーで読む行数, retries : 接続エラーの時に同じバッチをやり直す回数
+    progress : progress(読んだ行数, 最後の日付)をバッチごとに呼ぶ
+    返り値 : 列名をキー, 配列を値とするdictのイテレーター
+    """""
+    last_date = None
+    scanned = 0
+    while True:
+        query = charge_next_query(satellite_id=satellite_id, last_date=last_date, batch_size=batch_size)
+        rows = execute_with_retry(query, retries=retries)
+        if len(rows) == 0:
+            break
+        # 最後の行は帯電していなければ除く. batch_size行目なら続きがある
+        last = rows[-1]
+        is_full = last.row_number == batch_size
+        scanned += last.row_number
+        last_date = last.date
+        if not any(c is not None and c > 0 for c in (getattr(last, name) for name in NEXT_COLUMNS)):
+            rows = rows[:-1]
 
-# dmsp-f16~f18の帯電データを全て取得
-def GetChargeDataAll():
+        batch = to_charge_next_batch([row[:5 + len(NEXT_COLUMNS)] for row in rows])
+        if len(batch['date']) > 0:
+            yield batch
+        if progress is not None:
+            progress(scanned, last_date)
+        if not is_full:
+            break
+
+# 任意の衛星の帯電データを全て取得
+@QUERY_CACHE.cached
+def GetChargeDataBySatellite(satellite_id : int, batch_size : int = 100000) -> pd.DataFrame:
+    batches = list(IterChargeDataBySatellite(satellite_id=satellite_id, batch_size=batch_size))
+    columns = ['satellite_id', 'date', 'lat', 'lon', 'charge_count'] + NEXT_COLUMNS
+    if len(batches) == 0:
+        return pd.DataFrame(to_charge_next_batch([]), columns=columns)
+    return pd.DataFrame({name : np.concatenate([batch[name] for batch in batches]) for name in columns})
+
+# 任意の衛星の1分ごとのデータ（satellite_id, date, lat, lon, charge_count）を日付順にバッチで取得
+def IterChargeMinutes(satellite_id : int, batch_size : int = 100000, retries : int = 3,
+                      progress : Callable = None) -> Iterator[dict]:
+    last_date = None
+    scanned = 0
+    while True:
+        conditions = [Charge_Sat.satellite_id == satellite_id]
+        if last_date is not None:
+            conditions.append(Charge_Sat.date > last_date)
+        query = select(
+            Charge_Sat.satellite_id,
+            Charge_Sat.date,
+            Charge_Sat.lat,
+            Charge_Sat.lon,
+            Charge_Sat.charge_count,
+        ).where(*conditions).order_by(Charge_Sat.date).limit(batch_size)
+        rows = execute_with_retry(query, retries=retries)
+        if len(rows) == 0:
+            break
+
+        batch = to_charge_next_batch(rows)
+        scanned += len(rows)
+        last_date = rows[-1].date
+        yield batch
+        if progress is not None:
+            progress(scanned, last_date)
+        if len(rows) < batch_size:
+            break
+
+# 衛星・期間 [start, end) の1分ごとのデータを列ごとの配列で取得. (satellite_id, date)のインデックスの範囲検索になる
+def GetChargeRange(satellite_id, start : datetime, end : datetime, lat_range : tuple = None, abs_lat : bool = False,
+                   mlt_range : tuple = None, min_charge_count : int = None, retries : int = 3) -> dict:
+    """""
+    satellite_id : 衛星番号またはそのリスト
+    lat_range : 地磁気緯度の範囲 (最小, 最大). abs_lat=Trueの場合は|地磁気緯度|の範囲
+    mlt_range : 地磁気地方時の範囲 [最小, 最大). 最小 > 最大の場合は0時をまたぐ（例 : (21, 3)）
+    min_charge_count : charge_countがこれ以上の行だけ
+    返り値 : satellite_id (int16), date (datetime64[ns]), lat, lon (float32), charge_count (int16) の配列のdict
+    """""
+    table = Charge_Sat.__table__
+    satellites = [int(sat) for sat in np.atleast_1d(satellite_id)]
+    conditions = [table.c.satellite_id.in_(satellites), table.c.date >= start, table.c.date < end]
+    if lat_range is not None:
+        lat = func.abs(table.c.lat) if abs_lat else table.c.lat
+        conditions.append(lat.between(*lat_range))
+    if mlt_range is not None:
+        low, high = mlt_range
+        if low <= high:
+            conditions.append(and_(table.c.lon >= low, table.c.lon < high))
+        else:
+            conditions.append(or_(table.c.lon >= low, table.c.lon < high))
+    if min_charge_count is not None:
+        conditions.append(table.c.charge_count >= min_charge_count)
+
+    query = select(
+        table.c.satellite_id,
+        table.c.date,
+        table.c.lat,
+        table.c.lon,
+        table.c.charge_count,
+    ).where(*conditions).order_by(table.c.satellite_id, table.c.date)
+    return to_charge_next_batch(execute_with_retry(query, retries=retries))
+
+# 任意の衛星の1分ごとのデータに「N分後までに帯電するか」のラベルを付けて取得
+@QUERY_CACHE.cached
+def GetChargeLabels(satellite_id : int, horizons : tuple = HORIZONS, positive_only : bool = True,
+                    batch_size : int = 100000) -> pd.DataFrame:
+    """""
+    horizons : ラベルを求める時間（分）, positive_only : Trueの場合はいずれかのラベルがTrueの行だけを返す
+    """""
+    names = [get_label_name(horizon) for horizon in horizons]
     output = []
-    for i in range(16, 19):
-        tmp = GetChargeDataBySatellite(satellite_id=i)
-        output.extend(tmp)
-    columns = ['satellite_id', 'date', 'lat', 'lon', 'charge_count','one_minute_after', 
-               'two_minute_after', 'three_minute_after', 'four_minute_after','five_minute_after', 
-               'six_minute_after', 'seven_minute_after', 'eight_minute_after', 'nine_minute_after', 'ten_minute_after']
-    df = pd.DataFrame(output, columns=columns)
-    df.to_csv('charge.csv', index=False)
-
-
-# 任意の日付のcharge_countを更新
-def UpdateChargeCountByDate(path : str, start_id : int) -> int:
-    # csvを読み込み
-    df = pd.read_csv(path, parse_dates=['date'])
-    df.set_index('date', inplace=True)
-    charge_count_array = df.charge_channel.resample('MIN').apply(charge_count).values
-    # DBの読み込む最後のid
-    end_id = len(charge_count_array) - 1 + start_id
+    batches = IterChargeMinutes(satellite_id=satellite_id, batch_size=batch_size,
+                                progress=lambda n, date: print(f'dmsp-f{satellite_id} {n:,} rows {date}'))
+    for batch in iter_next_charge_labels(batches, horizons=horizons):
+        df = pd.DataFrame(batch)
+        output.append(df[df[names].any(axis=1)] if positive_only else df)
+    if len(output) == 0:
+        # 列の型はデータがある場合と同じにする
+        empty = to_charge_next_batch([])
+        empty.update({name : np.zeros(0, dtype=bool) for name in names})
+        return pd.DataFrame(empty, columns=['satellite_id', 'date', 'lat', 'lon', 'charge_count'] + names)
+    return pd.concat(output, ignore_index=True)
 
-    session_U = session() # updateセッションを生成
+# 1~10分後のcharge_countの列のDataFrame. 存在しないlead（-1）は以前のcsvと同じく空欄にする
+def to_next_count_frame(df : pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    for name in NEXT_COLUMNS:
+        df[name] = df[name].where(df[name] >= 0)
+    return df
 
-    # 更新する値を準備
-    update_value_lis = []
-    for i, c in enumerate(charge_count_array):
-        tmp_dict = {'id': start_id+i, 'charge_count':c}
-        update_value_lis.append(tmp_dict)
-    
-    # 更新
-    try:
-        session_U.bulk_update_mappings(
-            Charge_Sat,
-            update_value_lis,
-        )
-        session_U.commit()
-    except:
-        session_U.rollback()
-    finally:
-        session_U.close()
-
-    return end_id
-
-
-# 任意の衛星のcharge_countを更新
-def UpdateChargeCount(sat_index : int, start_year :int, end_year : int) -> None:
-    end_id = 0 # 初期値
-
-    for year in range(start_year, end_year+1):
-        for month in range(1, 13):
-            for day in range(1, 32):
-
-                month_str = str(month).zfill(2)
-                day_str = str(day).zfill(2)
-                path = f'/Volumes/USB/Processed_Data/dmsp-f{sat_index}/{year}/{month_str}/dmsp-f{sat_index}_{year}{month_str}{day_str}.csv'
-                
-                # charge_countを更新
-                try :
-                    start_id = get_date_id(satellite_id=sat_index, YMD=datetime(year=year, month=month, day=day))
-                    if end_id != 0 and start_id != end_id+1:
-                        raise 'start_idが間違っている'
-                    end_id = UpdateChargeCountByDate(path=path, start_id=start_id)
-                    print(f'{year}/{month_str}/{day_str}のupdate成功')
-                except:
-                    print(year, month, day)
-                    continue
+# dmsp-f16~f18の1分ごとのデータに「N分後までに帯電するか」のラベルを付けてcsvに書き込む
+def GetChargeDataAll(path : str = 'charge.csv', horizons : tuple = HORIZONS, positive_only : bool = True,
+                     batch_size : int = 100000, legacy : bool = False) -> None:
+    """""
+    legacy : Trueの場合はラベルの代わりに以前の列（1~10分後のcharge_count, analyze.ipynbで使う）を書き込む.
+             1~10分後のどこかで帯電している行だけになり、horizons, positive_onlyは使わない
+    """""
+    header = True
+    for i in range(16, 19):
+        if legacy:
+            df = to_next_count_frame(GetChargeDataBySatellite(satellite_id=i, batch_size=batch_size))
+        else:
+            df = GetChargeLabels(satellite_id=i, horizons=horizons, positive_only=positive_only, batch_size=batch_size)
+        df.to_csv(path, index=False, header=header, mode='w' if header else 'a')
+        header = False
 
 
+# 任意の衛星のcharge_countを再計算した値に更新. 期間内の値を一時テーブルに入れて、まとめて反映する
+def UpdateChargeCount(sat_index : int, start_year :int, end_year : int, ext : str = COLUMN_EXTENSION,
+                      batch_size : int = 1000000) -> int:
+    """""
+    batch_size : 1回のUPDATEで反映する行数
+    読み込めない日（charge_channelがない日など）, 反映できなかったバッチの日は表示して次の日に進む
+    返り値 : 更新された行数
+    """""
+    failed = []
+    with Bulk_Updater(engine=ENGINE, batch_size=batch_size) as updater:
+        for YMD, path in iter_processed_paths(sat_index, start_year, end_year, ext=ext):
+            try:
+                # charge_channelの列だけを読み込み
+                minute_df = aggregate_minute(read_day(path, columns=['date', 'charge_channel']).set_index('date'))
+            except Exception as e:
+                print(f'dmsp-f{sat_index} {YMD:%Y/%m/%d} failed : {e!r}')
+                failed.append(((sat_index, YMD), repr(e)))
+                continue
+            try:
+                updater.add(minute_df, sta_index=sat_index, YMD=YMD)
+            except Exception:
+                # 反映できなかったバッチの日はupdater.failedに記録されている
+                continue
+        try:
+            updater.flush()
+        except Exception:
+            pass
+    # 行数と最大のidは変わらないので、この衛星のキャッシュは自分で消す
+    QUERY_CACHE.clear(satellite_id=sat_index)
+    failed += updater.failed
+    if failed:
+        print(f'dmsp-f{sat_index} failed : {len(failed)} days {[f"{YMD:%Y/%m/%d}" for (_, YMD), _ in sorted(failed)]}')
+    return updater.updated
 
 
 if __name__ == '__main__':
@@ -0,0 +1,85 @@
+# 既存のchargeテーブルをmodels.Charge_Satのスキーマ（インデックス付き, 狭い型, created_atなし）に変換する
+# 1. (satellite_id, date)が重複している行を、idが最小の行だけ残して削除（ユニークインデックスを作るため）
+# 2. MySQL : ALTER TABLEを1回実行してその場で変換
+#    その他 : 新しいテーブルを作ってコピーし、入れ替える
+# 3. 集計テーブル（rollup.py）がなければ作って、全期間の集計を作る. chargeへの書き込みは集計テーブルも更新するので必要
+# 使い方 (src/dbディレクトリーで実行) : python migrate.py
+from models import Base, Charge_Sat
+from rollup import LEVELS, rebuild
+from setting import ENGINE
+from sqlalchemy import inspect, text
+
+TABLE = Charge_Sat.__tablename__
+OLD_TABLE = f'{TABLE}_old'
+
+
+# 移行済みかどうか
+def is_migrated(engine=ENGINE) -> bool:
+    indexes = [index['name'] for index in inspect(engine).get_indexes(TABLE)]
+    return 'ix_charge_satellite_date' in indexes
+
+# (satellite_id, date)が重複している行を削除. 削除した行数を返す
+def remove_duplicates(conn) -> int:
+    # MySQLでは削除するテーブルを副問い合わせで直接参照できないので、派生テーブルを挟む
+    result = conn.execute(text(
+        f'DELETE FROM {TABLE} WHERE id NOT IN ('
+        f'SELECT id FROM (SELECT MIN(id) AS id FROM {TABLE} GROUP BY satellite_id, date) AS keep_id)'
+    ))
+    return result.rowcount
+
+# MySQL : その場で列の型を変えてインデックスを追加する（テーブルの再構築は1回）
+def migrate_mysql(conn) -> None:
+    conn.execute(text(f'UPDATE {TABLE} SET charge_count = 0 WHERE charge_count IS NULL'))
+    conn.execute(text(
+        f'ALTER TABLE {TABLE} '
+        'MODIFY satellite_id SMALLINT NOT NULL, '
+        'MODIFY date DATETIME NOT NULL, '
+        'MODIFY lat FLOAT NULL, '
+        'MODIFY lon FLOAT NULL, '
+        'MODIFY charge_count SMALLINT NOT NULL DEFAULT 0, '
+        'DROP COLUMN created_at, '
+        'ADD UNIQUE INDEX ix_charge_satellite_date (satellite_id, date), '
+        'ADD INDEX ix_charge_charged (charge_count, satellite_id, date, lat, lon)'
+    ))
+
+# その他 : 新しいスキーマのテーブルにコピーして入れ替える
+def migrate_copy(conn) -> None:
+    conn.execute(text(f'ALTER TABLE {TABLE} RENAME TO {OLD_TABLE}'))
+    Charge_Sat.__table__.create(conn)
+    conn.execute(text(
+        f'INSERT INTO {TABLE} (id, satellite_id, date, lat, lon, charge_count) '
+        f'SELECT id, satellite_id, date, lat, lon, COALESCE(charge_count, 0) FROM {OLD_TABLE}'
+    ))
+    conn.execute(text(f'DROP TABLE {OLD_TABLE}'))
+
+# 作っていない集計テーブルの名前
+def get_missing_rollups(engine=ENGINE) -> list:
+    tables = inspect(engine).get_table_names()
+    return [model.__tablename__ for _, model, _ in LEVELS if model.__tablename__ not in tables]
+
+# 集計テーブルを作って、全期間の集計を作る
+def create_rollups(engine=ENGINE) -> None:
+    missing = get_missing_rollups(engine)
+    if len(missing) == 0:
+        return
+    Base.metadata.create_all(engine, tables=[model.__table__ for _, model, _ in LEVELS])
+    print(f'集計テーブルを作成 : {", ".join(missing)}')
+    rebuild(engine=engine)
+
+def main(engine=ENGINE) -> None:
+    if is_migrated(engine):
+        print('移行済みです')
+    else:
+        # MySQLのALTER TABLEは暗黙にコミットされるので、重複の削除とは別のトランザクションにする
+        with engine.begin() as conn:
+            print(f'重複を削除 : {remove_duplicates(conn)} 行')
+        with engine.begin() as conn:
+            if engine.dialect.name == 'mysql':
+                migrate_mysql(conn)
+            else:
+                migrate_copy(conn)
+        print('移行しました')
+    create_rollups(engine)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, String, ForeignKey
+from sqlalchemy import Column, String, ForeignKey, Index
 from setting import Base, ENGINE
-from sqlalchemy.types import Integer, String, DateTime, Float
+from sqlalchemy.types import Integer, SmallInteger, String, DateTime, Float
 from datetime import datetime
 
 
@@ -13,12 +13,38 @@ class Satellite(Base):
 class Charge_Sat(Base):
     __tablename__ = 'charge'
     id = Column(Integer, primary_key=True)
-    satellite_id = Column(Integer)
-    date = Column(DateTime)
-    lat = Column(Float)
-    lon = Column(Float)
-    charge_count = Column(Integer)
-    created_at = Column(DateTime, default=datetime.now)
+    satellite_id = Column(SmallInteger, nullable=False)
+    date = Column(DateTime, nullable=False)
+    lat = Column(Float(precision=24)) # 4バイトの浮動小数点数
+    lon = Column(Float(precision=24))
+    charge_count = Column(SmallInteger, nullable=False, default=0) # 1分間に帯電している秒数（0~60）
+    __table_args__ = (
+        # 衛星・時刻ごとに1行
+        Index('ix_charge_satellite_date', 'satellite_id', 'date', unique=True),
+        # 帯電している行の検索. PostgreSQL, SQLiteでは帯電している行だけの部分インデックス,
+        # MySQLでは部分インデックスがないのでcharge_countを先頭にした列を全て含むインデックス
+        Index('ix_charge_charged', 'charge_count', 'satellite_id', 'date', 'lat', 'lon',
+              postgresql_where=charge_count > 0, sqlite_where=charge_count > 0),
+    )
+
+
+# 集計テーブルの共通の列. startから1時間/1日/1か月の、地磁気地方時の区分（3時間ごと, -1は不明）ごとの集計
+class Charge_Rollup():
+    satellite_id = Column(SmallInteger, primary_key=True)
+    start = Column(DateTime, primary_key=True)
+    mlt_sector = Column(SmallInteger, primary_key=True)
+    charged_minutes = Column(Integer, nullable=False) # 帯電している分数
+    total_minutes = Column(Integer, nullable=False) # データがある分数
+    charge_seconds = Column(Integer, nullable=False) # 帯電している秒数（charge_countの和）
+
+class Charge_Hour(Charge_Rollup, Base):
+    __tablename__ = 'charge_hour'
+
+class Charge_Day(Charge_Rollup, Base):
+    __tablename__ = 'charge_day'
+
+class Charge_Month(Charge_Rollup, Base):
+    __tablename__ = 'charge_month'
 
 
 def main():
@@ -0,0 +1,165 @@
+# chargeテーブルの集計テーブル（1時間, 1日, 1か月ごと. 地磁気地方時の区分ごと）
+# 挿入・更新したchargeの行の日を、chargeテーブルから読み直して1時間・1日の集計を置き換える
+# 1か月の集計は1日の集計から求める
+# 集計の取得（crud.GetChargeSummary）は、期間を答えられる一番粗い集計テーブルを使う
+# 使い方 (src/dbディレクトリーで実行) : python rollup.py  全期間を作り直す
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from models import Base, Charge_Day, Charge_Hour, Charge_Month, Charge_Sat
+from setting import ENGINE
+from sqlalchemy import select
+
+# 地磁気地方時の区分の幅（時間）
+SECTOR_HOURS = 3
+ROLLUP_COLUMNS = ['satellite_id', 'start', 'mlt_sector', 'charged_minutes', 'total_minutes', 'charge_seconds']
+# 粗い順の集計テーブルとnumpyの時間の単位
+LEVELS = [
+    ('month', Charge_Month, 'M'),
+    ('day', Charge_Day, 'D'),
+    ('hour', Charge_Hour, 'h'),
+]
+
+
+# 地磁気地方時（lon）の区分. 欠損値は-1
+def get_mlt_sector(lon : np.ndarray) -> np.ndarray:
+    lon = np.asarray(lon, dtype=float)
+    sector = np.floor(np.nan_to_num(lon, nan=-1) % 24 / SECTOR_HOURS).astype(np.int64)
+    return np.where(np.isnan(lon), -1, sector)
+
+# 時刻をunit（'h', 'D', 'M'）の始まりに切り捨てる
+def floor_date(date : np.ndarray, unit : str) -> np.ndarray:
+    return np.asarray(date, dtype='datetime64[ns]').astype(f'datetime64[{unit}]').astype('datetime64[ns]')
+
+# chargeの行（satellite_id, date, lon, charge_count）をunitごとに集計
+def summarize(df : pd.DataFrame, unit : str) -> pd.DataFrame:
+    charge_count = df['charge_count'].values.astype(np.int64)
+    summary = pd.DataFrame({
+        'satellite_id' : df['satellite_id'].values.astype(np.int64),
+        'start' : floor_date(df['date'].values, unit),
+        'mlt_sector' : get_mlt_sector(df['lon'].values),
+        'charged_minutes' : (charge_count > 0).astype(np.int64),
+        'total_minutes' : np.ones(len(df), dtype=np.int64),
+        'charge_seconds' : charge_count,
+    })
+    return summary.groupby(['satellite_id', 'start', 'mlt_sector'], as_index=False).sum()[ROLLUP_COLUMNS]
+
+# 集計を粗い単位にまとめ直す
+def resummarize(df : pd.DataFrame, unit : str) -> pd.DataFrame:
+    df = df.assign(start=floor_date(df['start'].values, unit))
+    return df.groupby(['satellite_id', 'start', 'mlt_sector'], as_index=False).sum()[ROLLUP_COLUMNS]
+
+def to_python_records(df : pd.DataFrame) -> list:
+    records = df.astype(object).to_dict('records')
+    for record in records:
+        record['start'] = pd.Timestamp(record['start']).to_pydatetime()
+    return records
+
+# 集計テーブルの [start, end) を置き換える
+def replace_rollup(conn, model, satellite_id : int, start : datetime, end : datetime, df : pd.DataFrame) -> None:
+    table = model.__table__
+    conn.execute(table.delete().where(
+        table.c.satellite_id == satellite_id, table.c.start >= start, table.c.start < end,
+    ))
+    if len(df) > 0:
+        conn.execute(table.insert(), to_python_records(df))
+
+# 衛星の [start, end) の日の1時間・1日の集計を作り直す. start, endは日の始まり
+def refresh_days(conn, satellite_id : int, start : datetime, end : datetime) -> None:
+    table = Charge_Sat.__table__
+    query = select(table.c.satellite_id, table.c.date, table.c.lon, table.c.charge_count).where(
+        table.c.satellite_id == satellite_id, table.c.date >= start, table.c.date < end,
+    )
+    df = pd.DataFrame(conn.execute(query).all(), columns=['satellite_id', 'date', 'lon', 'charge_count'])
+    hour_df = summarize(df, 'h')
+    replace_rollup(conn, Charge_Hour, satellite_id, start, end, hour_df)
+    replace_rollup(conn, Charge_Day, satellite_id, start, end, resummarize(hour_df, 'D'))
+
+# 衛星の [start, end) の月の1か月の集計を、1日の集計から作り直す. start, endは月の始まり
+def refresh_months(conn, satellite_id : int, start : datetime, end : datetime) -> None:
+    table = Charge_Day.__table__
+    query = select(*[table.c[name] for name in ROLLUP_COLUMNS]).where(
+        table.c.satellite_id == satellite_id, table.c.start >= start, table.c.start < end,
+    )
+    df = pd.DataFrame(conn.execute(query).all(), columns=ROLLUP_COLUMNS)
+    if len(df) > 0:
+        df['start'] = pd.to_datetime(df['start'])
+    replace_rollup(conn, Charge_Month, satellite_id, start, end, resummarize(df, 'M'))
+
+# 挿入・更新した行（satellite_id, dateの列を含む）の範囲 {衛星番号 : (最初の日, 最後の日の翌日)}
+def get_ranges(df : pd.DataFrame) -> dict:
+    ranges = {}
+    day = floor_date(df['date'].values, 'D')
+    for satellite_id in np.unique(df['satellite_id'].values):
+        mask = df['satellite_id'].values == satellite_id
+        ranges[int(satellite_id)] = (day[mask].min(), day[mask].max() + np.timedelta64(1, 'D'))
+    return ranges
+
+# 日の範囲を含む月の範囲
+def get_month_range(start : np.datetime64, end : np.datetime64) -> tuple:
+    month_start = floor_date(np.array([start]), 'M')[0]
+    month_end = (np.datetime64(end - np.timedelta64(1, 'ns'), 'M') + 1).astype('datetime64[ns]')
+    return month_start, month_end
+
+def to_datetime(value : np.datetime64) -> datetime:
+    return pd.Timestamp(value).to_pydatetime()
+
+# 挿入・更新した行の集計を更新する. chargeへの書き込みと同じトランザクションで呼ぶ
+def refresh_rollups(conn, df : pd.DataFrame, months : bool = True) -> dict:
+    """""
+    months : Falseの場合は1か月の集計を更新しない（後でrefresh_month_rangesを呼ぶ）
+    返り値 : 更新した範囲 {衛星番号 : (最初の日, 最後の日の翌日)}
+    """""
+    ranges = get_ranges(df)
+    for satellite_id, (start, end) in ranges.items():
+        refresh_days(conn, satellite_id, to_datetime(start), to_datetime(end))
+    if months:
+        refresh_month_ranges(conn, ranges)
+    return ranges
+
+# 範囲を含む月の1か月の集計を更新する
+def refresh_month_ranges(conn, ranges : dict) -> None:
+    for satellite_id, (start, end) in ranges.items():
+        month_start, month_end = get_month_range(start, end)
+        refresh_months(conn, satellite_id, to_datetime(month_start), to_datetime(month_end))
+
+# 範囲をまとめる
+def merge_ranges(ranges : dict, other : dict) -> dict:
+    output = dict(ranges)
+    for satellite_id, (start, end) in other.items():
+        if satellite_id in output:
+            start, end = min(start, output[satellite_id][0]), max(end, output[satellite_id][1])
+        output[satellite_id] = (start, end)
+    return output
+
+# 期間の全ての集計を作り直す. 1か月ずつ処理する
+def rebuild(satellites : list = (16, 17, 18), start_year : int = 2004, end_year : int = 2022, engine=ENGINE) -> None:
+    Base.metadata.create_all(engine, tables=[model.__table__ for _, model, _ in LEVELS])
+    for satellite_id in satellites:
+        for month in pd.date_range(datetime(start_year, 1, 1), datetime(end_year, 12, 1), freq='MS'):
+            start = month.to_pydatetime()
+            end = (month + pd.offsets.MonthBegin(1)).to_pydatetime()
+            with engine.begin() as conn:
+                refresh_days(conn, satellite_id, start, end)
+                refresh_months(conn, satellite_id, start, end)
+        print(f'dmsp-f{satellite_id} rebuilt')
+
+# 時刻がunitの始まりかどうか
+def is_aligned(date : datetime, unit : str) -> bool:
+    value = np.datetime64(date, 'ns')
+    return floor_date(np.array([value]), unit)[0] == value
+
+# [start, end) を答えられる一番粗い集計テーブル. freqを指定した場合はfreq以下の細かさのもの
+def choose_level(start : datetime, end : datetime, freq : str = None) -> tuple:
+    names = [name for name, _, _ in LEVELS]
+    for name, model, unit in LEVELS:
+        if freq is not None and names.index(name) < names.index(freq):
+            continue
+        if is_aligned(start, unit) and is_aligned(end, unit):
+            return name, model, unit
+    raise ValueError(f'期間が1時間単位ではありません: {start} ~ {end}')
+
+
+if __name__ == '__main__':
+    rebuild()
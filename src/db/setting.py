@@ -1,5 +1,6 @@
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import scoped_session, sessionmaker
 
@@ -11,11 +12,52 @@ USER = os.getenv("USERNAME")
 PASSWD = os.getenv("PASSWORD")
 DB = os.getenv("DATABASE")
 
+# 接続先. DATABASE_URLがなければPlanetScaleのMySQLに接続する. 対応しているのはMySQLとSQLite
+# ローカルで使う場合の例 : DATABASE_URL=sqlite:///charge.db
+DATABASE_URL = os.getenv("DATABASE_URL")
+SSL_CA = os.getenv("DB_SSL_CA", "/etc/ssl/cert.pem")
+
+# コネクションプールの設定
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600")) # 秒. サーバー側で切られる前に接続を作り直す
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1" # 使う前に接続が生きているか確認する
+ECHO = os.getenv("DB_ECHO", "0") == "1" # 実行したSQLを表示する
+
+
+# SQLiteの接続ごとの設定. WALにすると読み込みと書き込みが同時にできる
+def set_sqlite_pragma(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+# 接続先に合わせてエンジンを作る
+def make_engine(url : str = None, pool_size : int = POOL_SIZE, max_overflow : int = MAX_OVERFLOW,
+                pool_recycle : int = POOL_RECYCLE, pool_pre_ping : bool = POOL_PRE_PING, echo : bool = ECHO):
+    """""
+    url : Noneの場合はDATABASE_URL, それもなければPlanetScaleのMySQL
+    """""
+    connect_args = {}
+    if url is None:
+        url = DATABASE_URL
+    if url is None:
+        url = f"mysql://{USER}:{PASSWD}@{HOST}/{DB}?ssl_mode=VERIFY_IDENTITY"
+        connect_args = {"ssl": {"ca": SSL_CA}}
+
+    options = {"echo" : echo, "pool_pre_ping" : pool_pre_ping, "connect_args" : connect_args}
+    backend = make_url(url).get_backend_name()
+    # メモリ上のSQLiteは1つの接続を使い回すのでプールの設定はしない
+    if not (backend == "sqlite" and make_url(url).database in (None, "", ":memory:")):
+        options.update(pool_size=pool_size, max_overflow=max_overflow, pool_recycle=pool_recycle)
+
+    engine = create_engine(url, **options)
+    if backend == "sqlite":
+        event.listen(engine, "connect", set_sqlite_pragma)
+    return engine
+
 # データベース接続
-ENGINE = create_engine(
-    f"mysql://{USER}:{PASSWD}@{HOST}/{DB}?ssl_mode=VERIFY_IDENTITY",
-    connect_args={"ssl": {"ca": "/etc/ssl/cert.pem"}},
-)
+ENGINE = make_engine()
 
 session = sessionmaker(autocommit=False,
                        autoflush=True,
@@ -23,4 +65,4 @@ session = sessionmaker(autocommit=False,
                        bind=ENGINE)
 # modelで使用する
 Base = declarative_base()
-# Base.query = session.query_property()
\ No newline at end of file
+# Base.query = session.query_property()
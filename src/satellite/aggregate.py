@@ -0,0 +1,143 @@
+# 1秒ごとのデータを1分ごとに集計する
+# 1日分を分ごとのグループに分け、全ての列を1回のreduceatで集計する
+#     lat, lon            分の最初の mag_lat, mag_ltime
+#     charge_count        帯電している秒数
+#     mean_lat, mean_lon  mag_lat の平均, mag_ltime の平均（24時をまたぐので円周上の平均）
+#     max_charge_channel  帯電チャンネルの最大値. -1は帯電していない
+#     peak_electron_flux  14keV以上のエレクトロンの流量の最大値
+# 入力にない列から求める特徴量は出力しない
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+# 帯電の検知に使う14keV以上のエレクトロンの列
+HIGH_ENERGY_ELECTRON = ['electron_30000eV', 'electron_20400eV', 'electron_13900eV']
+# データがない分の値. ここにない列はnan
+FILL_VALUE = {
+    'charge_count' : 0,
+    'max_charge_channel' : -1,
+}
+
+
+# 帯電している秒数を数える
+def charge_count(channel_array):
+    count = 0
+    for ch in channel_array:
+        if ch > 0:
+            count += 1
+    return count
+
+# 1秒ごとのデータを1分ごとに集計（旧実装）
+def aggregate_minute_loop(df : pd.DataFrame) -> pd.DataFrame:
+    output_df = pd.DataFrame({
+        'lat' : df.mag_lat.resample('MIN').first(),
+        'lon' : df.mag_ltime.resample('MIN').first(),
+        'charge_count' : df.charge_channel.resample('MIN').apply(charge_count),
+    })
+    return output_df
+
+# グループごとの最初の欠損値でない値
+def group_first(values : np.ndarray, starts : np.ndarray) -> np.ndarray:
+    position = np.where(np.isnan(values), len(values), np.arange(len(values)))
+    return np.append(values, np.nan)[np.minimum.reduceat(position, starts)]
+
+# グループごとの平均. 欠損値は除く
+def group_mean(values : np.ndarray, starts : np.ndarray) -> np.ndarray:
+    valid = ~np.isnan(values)
+    total = np.add.reduceat(np.where(valid, values, 0).astype(float), starts)
+    count = np.add.reduceat(valid.astype(np.int64), starts)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(count > 0, total / count, np.nan)
+
+# グループごとの円周上の平均. periodは周期
+def group_circular_mean(values : np.ndarray, starts : np.ndarray, period : float) -> np.ndarray:
+    valid = ~np.isnan(values)
+    angle = np.where(valid, values, 0) * 2 * np.pi / period
+    sin = np.add.reduceat(np.where(valid, np.sin(angle), 0), starts)
+    cos = np.add.reduceat(np.where(valid, np.cos(angle), 0), starts)
+    count = np.add.reduceat(valid.astype(np.int64), starts)
+    mean = np.arctan2(sin, cos) % (2 * np.pi) * period / (2 * np.pi)
+    return np.where(count > 0, mean, np.nan)
+
+# データがない分を埋めて1分ごとの連続したindexにする
+def fill_minutes(output_df : pd.DataFrame) -> pd.DataFrame:
+    if len(output_df) == 0:
+        return output_df
+    index = pd.date_range(output_df.index[0], output_df.index[-1], freq='min', name='date')
+    if len(index) == len(output_df):
+        return output_df
+    output = {}
+    for name in output_df.columns:
+        if name in FILL_VALUE:
+            output[name] = output_df[name].reindex(index, fill_value=FILL_VALUE[name])
+        else:
+            output[name] = output_df[name].reindex(index)
+    return pd.DataFrame(output)
+
+def empty_minute() -> pd.DataFrame:
+    return pd.DataFrame(columns=['lat', 'lon', 'charge_count'], index=pd.DatetimeIndex([], name='date'))
+
+# 1秒ごとのデータを1分ごとに集計
+def aggregate_minute(df : pd.DataFrame) -> pd.DataFrame:
+    """
+    df : indexがdateのDataFrame
+    返り値 : indexがdateのDataFrame. 列は lat, lon, charge_count と入力の列から求められる特徴量
+    """
+    if len(df) == 0:
+        return empty_minute()
+    minute = df.index.values.astype('datetime64[m]')
+    # 時刻順でない場合は分ごとに並べ替える（同じ分の中の順番は保つ）
+    order = None
+    if (minute[1:] < minute[:-1]).any():
+        order = np.argsort(minute, kind='stable')
+        minute = minute[order]
+
+    def column(name : str) -> np.ndarray:
+        values = df[name].values
+        return values if order is None else values[order]
+
+    starts = np.flatnonzero(np.r_[True, minute[1:] != minute[:-1]])
+    output = {}
+    if 'mag_lat' in df.columns:
+        output['lat'] = group_first(column('mag_lat'), starts)
+    if 'mag_ltime' in df.columns:
+        output['lon'] = group_first(column('mag_ltime'), starts)
+    if 'charge_channel' in df.columns:
+        channel = column('charge_channel')
+        output['charge_count'] = np.add.reduceat((channel > 0).astype(np.int64), starts)
+    if 'mag_lat' in df.columns:
+        output['mean_lat'] = group_mean(column('mag_lat'), starts).astype(output['lat'].dtype)
+    if 'mag_ltime' in df.columns:
+        output['mean_lon'] = group_circular_mean(column('mag_ltime'), starts, period=24).astype(output['lon'].dtype)
+    if 'charge_channel' in df.columns:
+        output['max_charge_channel'] = np.maximum.reduceat(channel, starts)
+    electron = [name for name in HIGH_ENERGY_ELECTRON if name in df.columns]
+    if electron:
+        flux = np.fmax.reduce(np.stack([column(name) for name in electron], axis=1), axis=1)
+        output['peak_electron_flux'] = np.fmax.reduceat(flux, starts)
+
+    index = pd.DatetimeIndex(minute[starts].astype('datetime64[ns]'), name='date')
+    return fill_minutes(pd.DataFrame(output, index=index))
+
+# チャンクごとに1分ごとに集計して連結. チャンクの境界をまたぐ分は次のチャンクと一緒に集計する
+def aggregate_minute_chunks(chunks : Iterable[pd.DataFrame]) -> pd.DataFrame:
+    output = []
+    carry = None
+    for df in chunks:
+        df = df.set_index('date')
+        if carry is not None:
+            df = pd.concat([carry, df])
+        if len(df) == 0:
+            continue
+        # 最後の分は次のチャンクに続く可能性がある
+        minute = df.index.values.astype('datetime64[m]')
+        last = minute == minute.max()
+        carry = df[last]
+        output.append(aggregate_minute(df[~last]))
+    if carry is not None and len(carry) > 0:
+        output.append(aggregate_minute(carry))
+    output = [minute_df for minute_df in output if len(minute_df) > 0]
+    if len(output) == 0:
+        return empty_minute()
+    return fill_minutes(pd.concat(output))
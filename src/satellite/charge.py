@@ -1,5 +1,9 @@
+import hashlib
+import json
 import os
 from datetime import datetime
+from functools import partial
+from typing import Iterator
 
 import cdflib
 import matplotlib.pyplot as plt
@@ -9,44 +13,103 @@ import scipy.stats as stats
 import seaborn as sns
 from matplotlib.colors import LogNorm
 
+from .executor import run_days
+from .storage import COLUMN_EXTENSION, PROCESSED_DIR, add_column, find_processed_path, load_columns
+
+# 帯電検知の結果を日ごとに保存するディレクトリー
+CACHE_DIR = f'{PROCESSED_DIR}/charge_cache'
+
 
 class SAT_Charge():
+    # スミルノフ･グラブス検定の臨界値のキャッシュ. key = (alpha, データ数)
+    tau_cache = {}
 
-    def __init__(self) -> None:
+    def __init__(self, cache_dir : str = None) -> None:
         self.channel = np.array([ 30000, 20400, 13900, 9450, 6460, 4400, 3000,\
                                  2040, 1392, 949, 646, 440, 300, 204, 139, 95, 65, 44, 30], dtype=float)
         
         self.charge_range = list(range(7, 16))
+
+        # 帯電検知のパラメーター
+        self.alpha = 0.01
+        self.electron_threshold = 1e8 # 14keV以上のelectronの流量
+        self.ion_mean_threshold = 1e9 # イオンの全チャンネルの平均
+        self.outlier_threshold = 1e7 # 異常値
+
+        # 帯電検知の結果のキャッシュ. cache_dirがNoneの場合はディスクに保存しない
+        self.cache_dir = cache_dir
+        self.cache_name = None
+        self.charge_cache = None
         
     def open(self, path):
+        # 複数日のcdfのリスト
+        if isinstance(path, (list, tuple)):
+            self.open_cdf(path=path)
+            names = [os.path.basename(p).split('.')[0] for p in path]
+            self.cache_name = f'{names[0]}_{names[-1]}'
+            return
         _, extension = os.path.splitext(path)
         if extension == '.cdf':
             self.open_cdf(path=path)
         elif extension == '.csv':
             self.open_csv(path=path)
+        elif extension == COLUMN_EXTENSION:
+            self.open_columns(path=path)
+        self.cache_name = os.path.basename(path).split('.')[0]
     
-    # cdf を開く
-    def open_cdf(self, path : str) -> None:
-        cdf_file = cdflib.CDF(path)
+    # cdfのEpochをdatetime64[ns]に変換
+    def convert_epoch(self, epoch : np.ndarray) -> np.ndarray:
+        epoch = np.asarray(epoch)
+        if epoch.dtype == np.float64:
+            # CDF_EPOCH : 0000-01-01からのミリ秒. cdflibと同じくミリ秒未満は切り捨てる
+            unix_ms = np.floor(epoch - 62167219200000.0).astype(np.int64)
+            return unix_ms.astype('datetime64[ms]').astype('datetime64[ns]')
+        # CDF_TT2000などはcdflibで変換する
+        unix_us = np.round(np.asarray(cdflib.cdfepoch.unixtime(epoch), dtype=float) * 1e6).astype(np.int64)
+        return unix_us.astype('datetime64[us]').astype('datetime64[ns]')
+
+    # cdf を開く. 複数日のパスのリストを渡すと連結する
+    def open_cdf(self, path) -> None:
+        paths = [path] if isinstance(path, str) else list(path)
+        ion, electron, date, lat, ltime = [], [], [], [], []
+        # 必要な変数だけを読み込む
+        for p in paths:
+            cdf_file = cdflib.CDF(p)
+            ion.append(cdf_file.varget('ION_DIFF_ENERGY_FLUX'))
+            electron.append(cdf_file.varget('ELE_DIFF_ENERGY_FLUX'))
+            date.append(self.convert_epoch(cdf_file.varget('Epoch')))
+            lat.append(cdf_file.varget('SC_AACGM_LAT'))
+            ltime.append(cdf_file.varget('SC_AACGM_LTIME'))
+
+        self.cache_name = None
+        self.charge_cache = None
         # イオン, エレクトロン
-        self.ion = cdf_file['ION_DIFF_ENERGY_FLUX']
-        self.electron = cdf_file['ELE_DIFF_ENERGY_FLUX']
+        self.ion = np.concatenate(ion).astype(float)
+        self.electron = np.concatenate(electron).astype(float)
         # 日にち
-        epoch = cdflib.cdfepoch.unixtime(cdf_file['Epoch'])
-        self.date = [datetime.utcfromtimestamp(e) for e in epoch]
+        self.date = np.concatenate(date)
         # 緯度経度（地磁気座標系）
-        self.lat = abs(cdf_file['SC_AACGM_LAT'])
-        self.lon = cdf_file['SC_AACGM_LTIME'] * np.pi / 12
+        self.lat = abs(np.concatenate(lat).astype(float))
+        self.lon = np.concatenate(ltime).astype(float) * np.pi / 12
     
     # csvを開く
     def open_csv(self, path : str):
-        
-        self.df = pd.read_csv(path, parse_dates=['date'])
+        self.open_df(pd.read_csv(path, parse_dates=['date']))
+
+    # 列指向フォーマットを開く
+    def open_columns(self, path : str):
+        self.open_df(load_columns(path))
+
+    # preprocessで作成したDataFrameを開く
+    def open_df(self, df : pd.DataFrame) -> None:
+        self.df = df
+        self.cache_name = None
+        self.charge_cache = None
         # イオン, エレクトロン
-        self.ion = self.df.values[:, 27:46].astype(float)
-        self.electron = self.df.values[:, 8:27].astype(float)
+        self.ion = self.df[[f'ion_{ch:.0f}eV' for ch in self.channel]].values.astype(float)
+        self.electron = self.df[[f'electron_{ch:.0f}eV' for ch in self.channel]].values.astype(float)
         # 日にち
-        self.date = self.df.values[:, 0]
+        self.date = self.df['date'].values
         # 緯度経度（地磁気座標系）
         self.lat = abs(self.df.mag_lat.values.astype(float))
         self.lon = self.df.mag_ltime.values.astype(float) * np.pi / 12
@@ -85,13 +148,24 @@ class SAT_Charge():
         plt.grid()
         plt.legend();
 
+    # スミルノフ･グラブス検定の臨界値
+    def get_tau(self, alpha : float, n : int) -> float:
+        key = (alpha, n)
+        if key not in self.tau_cache:
+            t = stats.t.isf(q=(alpha / n) / 2, df=n - 2)
+            self.tau_cache[key] = (n - 1) * t / np.sqrt(n * (n - 2) + n * t * t)
+        return self.tau_cache[key]
+
+    # データ数ごとの臨界値の表. index = データ数（2以下は検定しない）
+    def get_tau_table(self, alpha : float, n_max : int) -> np.ndarray:
+        return np.array([np.inf] * 3 + [self.get_tau(alpha, n) for n in range(3, n_max + 1)])
+
     # スミルノフ･グラブス検定
     def smirnov_grubbs(self, data, alpha):
         x, o = list(data), []
         while len(x) > 2:
             n = len(x)
-            t = stats.t.isf(q=(alpha / n) / 2, df=n - 2)
-            tau = (n - 1) * t / np.sqrt(n * (n - 2) + n * t * t)
+            tau = self.get_tau(alpha, n)
             i_min, i_max = np.argmin(x), np.argmax(x)
             myu, std = np.mean(x), np.std(x, ddof=1)
             i_far = i_max if np.abs(x[i_max] - myu) > np.abs(x[i_min] - myu) else i_min
@@ -102,45 +176,157 @@ class SAT_Charge():
         o.sort(reverse=True)
         return np.array(o)
 
-    # 帯電している時間を検知
-    def detect_charge(self):
+    # 1行分の帯電チャンネルを検知（detect_charge_loopの1行分の処理）
+    def detect_row(self, i : int, alpha : float) -> list:
+        charge_id = []
+        check_ion = self.ion[i][self.ion[i] > 0]
+        if len(check_ion) <= 2:
+            return charge_id
+
+        # イオンの全チャンネルの値が大きい時
+        if check_ion.mean() > self.ion_mean_threshold:
+            return charge_id
+        
+        # 異常値検出
+        out_array = self.smirnov_grubbs(check_ion, alpha)
+
+        for out_value in out_array:
+            ch = np.where(self.ion[i] == out_value)[0].item()
+            # 異常値は1e7以上で、95eV以上2040eV以下
+            if ch in self.charge_range and out_value > self.outlier_threshold:
+                charge_id.append((i, ch))
+        return charge_id
+
+    # 帯電している時間を検知. 1行ずつ処理する旧実装. detect_chargeとの比較用
+    def detect_charge_loop(self):
         check_id_list = []
-        alpha = 0.01
+        alpha = self.alpha
         charge_id = []
         # 14keV以上のelectronの流量が10^8以上
         for i, ele in enumerate(self.electron):
-            if any(ele[:3] > 1e8):
+            if any(ele[:3] > self.electron_threshold):
                 check_id_list.append(i)
 
         for i in check_id_list:
-            check_ion = self.ion[i][self.ion[i] > 0]
-            if len(check_ion) <= 2:
-                continue
-
-            # イオンの全チャンネルの値が大きい時
-            if check_ion.mean() > 1e9:
-                continue
-            
-            # 異常値検出
-            out_array = self.smirnov_grubbs(check_ion, alpha)
-
-            if len(out_array) == 0:
-                continue
-
-            for out_value in out_array:
-                ch = np.where(self.ion[i] == out_value)[0].item()
-                # 異常値は1e7以上で、95eV以上2040eV以下
-                if ch in self.charge_range and out_value > 1e7:
-                    charge_id.append((i, ch))
-                    continue
+            charge_id.extend(self.detect_row(i, alpha))
 
         return charge_id
 
+    # 帯電している時間を検知. 候補の行をまとめてスミルノフ･グラブス検定する
+    def detect_charge(self):
+        alpha = self.alpha
+        # 14keV以上のelectronの流量が10^8以上
+        check_id = np.flatnonzero((self.electron[:, :3] > self.electron_threshold).any(axis=1))
+        ion = self.ion[check_id]
+        active = ion > 0
+        n = active.sum(axis=1)
+        mean = np.where(active, ion, 0).sum(axis=1) / np.maximum(n, 1)
+
+        # イオンの全チャンネルの値が大きい時は除く
+        running = (n > 2) & ~(mean > self.ion_mean_threshold)
+        # 閾値との差が丸め誤差程度の行は、最後に1行ずつの処理で判定し直す
+        uncertain = (n > 2) & np.isclose(mean, self.ion_mean_threshold, rtol=1e-9, atol=0)
+
+        tau_table = self.get_tau_table(alpha, ion.shape[1])
+        out_row, out_ch = [], []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # 検定を続ける行だけを取り出して、異常値がなくなるまで1つずつ取り除く
+            idx = np.flatnonzero(running)
+            while len(idx) > 0:
+                x, act = ion[idx], active[idx]
+                rows = np.arange(len(idx))
+                n = act.sum(axis=1)
+                myu = np.where(act, x, 0).sum(axis=1) / n
+                std = np.sqrt(np.where(act, (x - myu[:, None]) ** 2, 0).sum(axis=1) / (n - 1))
+                i_min = np.where(act, x, np.inf).argmin(axis=1)
+                i_max = np.where(act, x, -np.inf).argmax(axis=1)
+                i_far = np.where(np.abs(x[rows, i_max] - myu) > np.abs(x[rows, i_min] - myu), i_max, i_min)
+                tau_far = np.abs((x[rows, i_far] - myu) / std)
+
+                tau = tau_table[n]
+                uncertain[idx] |= np.isclose(tau_far, tau, rtol=1e-9, atol=0)
+                outlier = ~(tau_far < tau)
+                # 異常値を取り除く
+                out_row.append(idx[outlier])
+                out_ch.append(i_far[outlier])
+                active[idx[outlier], i_far[outlier]] = False
+                # データが2つ以下になった行は終わり
+                idx = idx[outlier & (n - 1 > 2)]
+
+        out_row = np.concatenate(out_row) if out_row else np.zeros(0, dtype=int)
+        out_ch = np.concatenate(out_ch) if out_ch else np.zeros(0, dtype=int)
+        out_value = ion[out_row, out_ch]
+        # 異常値は1e7以上で、95eV以上2040eV以下
+        mask = np.isin(out_ch, self.charge_range) & (out_value > self.outlier_threshold) & ~uncertain[out_row]
+        # 行の順, 同じ行では異常値の大きい順に並べる
+        order = np.lexsort((-out_value[mask], out_row[mask]))
+        charge_id = list(zip(check_id[out_row[mask]][order].tolist(), out_ch[mask][order].tolist()))
+
+        for i in check_id[uncertain].tolist():
+            charge_id.extend(self.detect_row(i, alpha))
+        return sorted(charge_id, key=lambda x: x[0])
+
+    # 帯電検知のパラメーター. キャッシュのキーに使う
+    def get_detect_params(self) -> dict:
+        return {
+            'alpha' : self.alpha,
+            'electron_threshold' : self.electron_threshold,
+            'ion_mean_threshold' : self.ion_mean_threshold,
+            'outlier_threshold' : self.outlier_threshold,
+            'charge_range' : [int(ch) for ch in self.charge_range],
+        }
+
+    # 入力データ（イオン, エレクトロンの流量）のハッシュ
+    def get_data_hash(self) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        for data in (self.electron, self.ion):
+            h.update(np.ascontiguousarray(data, dtype=float))
+        return h.hexdigest()
+
+    # ディスクのキャッシュを読み込む. 入力データかパラメーターが変わっていればNone
+    def read_cache(self, path : str, data_hash : str, params : dict) -> list:
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            cache = json.load(f)
+        if cache['hash'] != data_hash or cache['params'] != params:
+            return None
+        return [tuple(x) for x in cache['charge_id']]
+
+    # ディスクにキャッシュを書き込む. ディレクトリーは複数のプロセスが同時に作ることがある
+    def write_cache(self, path : str, data_hash : str, params : dict, charge_id : list) -> None:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'hash' : data_hash, 'params' : params, 'charge_id' : [[int(i), int(ch)] for i, ch in charge_id]}, f)
+        os.replace(tmp_path, path)
+
+    # 帯電している(行, チャンネル)を取得. 同じデータ・パラメーターでは検知をやり直さない
+    def get_charge_id(self) -> list:
+        params = self.get_detect_params()
+        if self.charge_cache is not None and self.charge_cache[0] == params:
+            return self.charge_cache[1]
+
+        charge_id = None
+        cache_path = None
+        if self.cache_dir is not None and self.cache_name is not None:
+            cache_path = os.path.join(self.cache_dir, f'{self.cache_name}.json')
+            data_hash = self.get_data_hash()
+            charge_id = self.read_cache(cache_path, data_hash, params)
+
+        if charge_id is None:
+            charge_id = self.detect_charge()
+            if cache_path is not None:
+                self.write_cache(cache_path, data_hash, params, charge_id)
+
+        self.charge_cache = (params, charge_id)
+        return charge_id
+
     # 帯電している位置を取得（地磁気座標系）
     def get_charge_pos(self):
         La = []
         Lo = []
-        ind = self.detect_charge()
+        ind = self.get_charge_id()
         for i, _ in ind:
             La.append(self.lat[i])
             Lo.append(self.lon[i])
@@ -153,40 +339,45 @@ class SAT_Charge():
         ax.scatter(Lo, La)
         ax.set_ylim([90,40]);
     
+    # 各行の帯電チャンネル. -1は帯電していない。
+    def get_charge_channel(self) -> np.ndarray:
+        channel = np.full(len(self.ion), -1)
+        for i, ch in self.get_charge_id():
+            channel[i] = ch
+        return channel
+
     # 帯電チャンネルを追加. -1は帯電していない。
     def add_charge_col(self, save_path : str) -> None:
-        try:
-            length = len(self.df)
-        except:
-            pass
-
-        charge_index_channel = self.detect_charge()
-        channel = [-1] * length
-        for i, ch in charge_index_channel:
-            channel[i] = ch
-        self.df['charge_channel'] = channel
-        # 保存
-        self.df.to_csv(save_path, index=False)
-
-
-def main(index : int, start_year : int, end_year : int):
-    sat = SAT_Charge()
-    for year in range(start_year, end_year+1):
-        for month in range(1, 13):
-            for day in range(1, 32):
-                print(year, month, day)
-
-                month_str = str(month).zfill(2)
-                day_str = str(day).zfill(2)
-                save_dir = f'/Volumes/USB/Processed_Data/dmsp-f{index}/{year}/{month_str}/'
-                save_file = f'dmsp-f{index}_{year}{month_str}{day_str}.csv'
-
-                try :
-                    sat.open(save_dir+save_file)
-                    # 帯電情報を追加
-                    sat.add_charge_col(save_path=save_dir+save_file)
-                except:
-                    continue
+        self.df['charge_channel'] = self.get_charge_channel()
+        # 保存. 列指向フォーマットの場合はcharge_channelの列だけを書き込む
+        _, extension = os.path.splitext(save_path)
+        if extension == COLUMN_EXTENSION:
+            add_column(save_path, 'charge_channel', self.df['charge_channel'].values)
+        else:
+            self.df.to_csv(save_path, index=False)
+
+    # チャンクごとに帯電チャンネルを追加するジェネレーター
+    def iter_charge_col(self, chunks : Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        for df in chunks:
+            self.open_df(df)
+            df['charge_channel'] = self.get_charge_channel()
+            yield df
+
+
+# 1日分の処理済みデータに帯電情報を追加
+def charge_day(index : int, YMD : datetime, ext : str = COLUMN_EXTENSION, cache_dir : str = CACHE_DIR) -> None:
+    # 列指向フォーマットがない日はcsvに追加する
+    path = find_processed_path(index=index, YMD=YMD, ext=ext)
+    if path is None:
+        raise FileNotFoundError(f'dmsp-f{index} {YMD:%Y/%m/%d}')
+    sat = SAT_Charge(cache_dir=cache_dir)
+    sat.open(path)
+    sat.add_charge_col(save_path=path)
+
+def main(index : int, start_year : int, end_year : int, ext : str = COLUMN_EXTENSION, workers : int = None, cache_dir : str = CACHE_DIR):
+    start = datetime(year=start_year, month=1, day=1)
+    end = datetime(year=end_year, month=12, day=31)
+    return run_days(partial(charge_day, ext=ext, cache_dir=cache_dir), index=index, start=start, end=end, workers=workers)
 
 if __name__ == '__main__':
     index = 17
@@ -0,0 +1,66 @@
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from typing import Callable, Iterator, List, NamedTuple
+
+import pandas as pd
+
+
+# 1日分の処理結果. statusは 'ok', 'missing'（ファイルがない）, 'failed'
+class Day_Result(NamedTuple):
+    date : datetime
+    status : str
+    duration : float
+    error : str = ''
+
+
+# 期間内の日付を取得（start, endの日も含む. 存在しない日付は含まない）
+def get_days(start : datetime, end : datetime) -> List[datetime]:
+    return list(pd.date_range(start, end, freq='D').to_pydatetime())
+
+# 1日分の処理を実行して結果を記録
+def run_day(func : Callable, index : int, YMD : datetime) -> Day_Result:
+    st = time.perf_counter()
+    try:
+        func(index, YMD)
+        status, error = 'ok', ''
+    except FileNotFoundError as e:
+        status, error = 'missing', str(e)
+    except Exception as e:
+        status, error = 'failed', repr(e)
+    return Day_Result(YMD, status, time.perf_counter() - st, error)
+
+# 期間内の各日にfunc(index, YMD)をプロセスプールで実行し、終わった日から結果を返す
+def iter_days(func : Callable, index : int, start : datetime, end : datetime,
+              workers : int = None, ordered : bool = True) -> Iterator[Day_Result]:
+    """""
+    func : 1日分の処理. プロセス間で受け渡すためモジュールの関数にする
+    workers : プロセス数. Noneの場合はCPUのコア数, 1の場合は同じプロセスで順に実行
+    ordered : Trueの場合は日付順, Falseの場合は終わった順に結果を返す
+    """""
+    days = get_days(start, end)
+    if workers == 1:
+        for YMD in days:
+            yield run_day(func, index, YMD)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_day, func, index, YMD) for YMD in days]
+        if not ordered:
+            futures = as_completed(futures)
+        for future in futures:
+            yield future.result()
+
+# 期間内の各日を処理して全ての結果を返す
+def run_days(func : Callable, index : int, start : datetime, end : datetime,
+             workers : int = None, ordered : bool = True, verbose : bool = True) -> List[Day_Result]:
+    results = []
+    for result in iter_days(func, index, start, end, workers=workers, ordered=ordered):
+        if verbose:
+            print(f'dmsp-f{index} {result.date:%Y/%m/%d} {result.status} {result.duration:.1f}s {result.error}')
+        results.append(result)
+
+    if verbose:
+        print(dict(Counter(r.status for r in results)))
+    return results
@@ -0,0 +1,76 @@
+# 帯電予測の正解ラベル
+# 各行について「N分後までに帯電しているか」を衛星ごとに求める
+# 行が1分ごとに並んでいることは仮定しない. 時刻が (date, date + N分] の行だけを見るので、データの欠けた時間はまたがない
+from typing import Iterable, Iterator
+
+import numpy as np
+
+# ラベルを求める時間（分）
+HORIZONS = (5, 10, 30, 60)
+
+
+# ラベルの列名
+def get_label_name(horizon : int) -> str:
+    return f'charge_within_{horizon}min'
+
+# 衛星番号と時刻（分）を1つの整数にする. 衛星番号, 時刻の順に並べられる
+def get_minute_key(satellite_id : np.ndarray, date : np.ndarray) -> np.ndarray:
+    minute = np.asarray(date).astype('datetime64[m]').astype(np.int64)
+    return np.asarray(satellite_id).astype(np.int64) * 10**9 + minute
+
+# horizonsごとに、N分後までに帯電しているかのラベルを求める
+def get_next_charge_labels(satellite_id : np.ndarray, date : np.ndarray, charge_count : np.ndarray,
+                           horizons : Iterable[int] = HORIZONS) -> dict:
+    """""
+    satellite_id, date, charge_count : 同じ長さの配列. 順番は問わない
+    返り値 : 列名をキー, bool配列を値とするdict
+    """""
+    key = get_minute_key(satellite_id, date)
+    order = None
+    if (key[1:] < key[:-1]).any():
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        charge_count = np.asarray(charge_count)[order]
+
+    # 帯電している行数の累積和. cumsum[j] - cumsum[i + 1] が (i, j) の行の帯電数
+    charged = np.concatenate([[0], np.cumsum(np.asarray(charge_count) > 0)])
+    # 同じ時刻の行が重なっていても、自分より後の時刻だけを見る
+    start = np.searchsorted(key, key, side='right')
+    output = {}
+    for horizon in horizons:
+        end = np.searchsorted(key, key + horizon, side='right')
+        label = charged[end] - charged[start] > 0
+        if order is not None:
+            label = label[np.argsort(order)]
+        output[get_label_name(horizon)] = label
+    return output
+
+# 日付順のバッチ（列名をキー, 配列を値とするdict）にラベルを追加するジェネレーター
+def iter_next_charge_labels(batches : Iterable[dict], horizons : Iterable[int] = HORIZONS) -> Iterator[dict]:
+    """""
+    バッチの最後のmax(horizons)分の行は次のバッチを見ないとラベルが決まらないので、次のバッチと一緒に返す
+    バッチは衛星ごと・日付順に並んでいること
+    """""
+    horizons = tuple(horizons)
+    max_horizon = np.timedelta64(max(horizons), 'm')
+    carry = None
+    for batch in batches:
+        if carry is not None:
+            batch = {name : np.concatenate([carry[name], values]) for name, values in batch.items()}
+        if len(batch['date']) == 0:
+            continue
+        labels = get_next_charge_labels(batch['satellite_id'], batch['date'], batch['charge_count'], horizons)
+        # 最後の時刻からmax_horizon以内の行は次のバッチに回す
+        date = batch['date'].astype('datetime64[m]')
+        done = (date <= date[-1] - max_horizon) | (batch['satellite_id'] != batch['satellite_id'][-1])
+        carry = {name : values[~done] for name, values in batch.items()}
+        if done.any():
+            output = {name : values[done] for name, values in batch.items()}
+            output.update({name : label[done] for name, label in labels.items()})
+            yield output
+
+    # 最後のバッチ. データの終わりより後は帯電していないとみなす
+    if carry is not None and len(carry['date']) > 0:
+        labels = get_next_charge_labels(carry['satellite_id'], carry['date'], carry['charge_count'], horizons)
+        carry.update(labels)
+        yield carry
@@ -0,0 +1,199 @@
+# 帯電の発生頻度マップ（|地磁気緯度| × 地磁気地方時の2次元ヒストグラム）
+# 衛星/年/月ごとに以下の3つの配列を持ち、日ごとに足していく
+#     dwell   滞在時間（秒数）
+#     charge  帯電している秒数
+#     event   帯電の回数（帯電していない秒から帯電している秒に変わった回数）
+# 配列は足し合わせるだけなので、プロセスごとに作ったマップをmergeでまとめられる
+# 季節・年・衛星を選んだ発生頻度は配列の和 charge / dwell から求める
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+from .executor import get_days
+from .storage import COLUMN_EXTENSION, PROCESSED_DIR, find_processed_path, get_missing_columns, read_day
+
+OCCURRENCE_PATH = f'{PROCESSED_DIR}/occurrence.npz'
+# 配列の種類
+COUNT_NAMES = ['dwell', 'charge', 'event']
+# 季節ごとの月
+SEASONS = {
+    'winter' : [12, 1, 2],
+    'spring' : [3, 4, 5],
+    'summer' : [6, 7, 8],
+    'autumn' : [9, 10, 11],
+}
+
+
+class Occurrence_Map():
+
+    def __init__(self, lat_step : float = 1.0, mlt_step : float = 0.5, lat_min : float = 40.0) -> None:
+        """""
+        lat_step : |地磁気緯度|のビンの幅（度）, mlt_step : 地磁気地方時のビンの幅（時間）
+        lat_min : これより低緯度は数えない
+        """""
+        self.lat_edges = np.arange(lat_min, 90 + lat_step / 2, lat_step)
+        self.mlt_edges = np.arange(0, 24 + mlt_step / 2, mlt_step)
+        self.shape = (len(COUNT_NAMES), len(self.lat_edges) - 1, len(self.mlt_edges) - 1)
+        # key = (衛星番号, 年, 月), value = shapeの配列
+        self.counts = {}
+        # 追加済みの日. 同じ日を2回数えないようにする
+        self.days = set()
+
+    # 1秒ごとのデータ（mag_lat, mag_ltime, charge_channel）のヒストグラム
+    def histogram(self, df : pd.DataFrame) -> np.ndarray:
+        mag_lat = np.abs(df['mag_lat'].values)
+        mag_ltime = df['mag_ltime'].values % 24
+        charged = df['charge_channel'].values > 0
+        # 帯電の始まり. 前の秒が帯電していない
+        onset = charged & ~np.concatenate([[False], charged[:-1]])
+
+        lat_id = np.searchsorted(self.lat_edges, mag_lat, side='right') - 1
+        mlt_id = np.searchsorted(self.mlt_edges, mag_ltime, side='right') - 1
+        # 90度ちょうどは最後のビンに入れる
+        lat_id[mag_lat == self.lat_edges[-1]] = self.shape[1] - 1
+        valid = (lat_id >= 0) & (lat_id < self.shape[1]) & (mlt_id >= 0) & (mlt_id < self.shape[2])
+
+        cell = lat_id[valid] * self.shape[2] + mlt_id[valid]
+        size = self.shape[1] * self.shape[2]
+        output = np.zeros(self.shape, dtype=np.int64)
+        for i, weight in enumerate([None, charged[valid], onset[valid]]):
+            output[i] = np.bincount(cell, weights=weight, minlength=size).reshape(self.shape[1:])
+        return output
+
+    # 1日分を追加. 追加済みの日はFalseを返す
+    def add(self, index : int, YMD : datetime, df : pd.DataFrame) -> bool:
+        day = (index, YMD.strftime('%Y%m%d'))
+        if day in self.days:
+            return False
+        key = (index, YMD.year, YMD.month)
+        if key not in self.counts:
+            self.counts[key] = np.zeros(self.shape, dtype=np.int64)
+        self.counts[key] += self.histogram(df)
+        self.days.add(day)
+        return True
+
+    # 処理済みデータから1日分を追加. extのファイルがない日はcsvを読み、どちらもない日はFalseを返す
+    # 列が足りない日（charge.mainでcharge_channelを追加していない日など）もFalseを返す
+    def add_day(self, index : int, YMD : datetime, ext : str = COLUMN_EXTENSION) -> bool:
+        if (index, YMD.strftime('%Y%m%d')) in self.days:
+            return False
+        path = find_processed_path(index=index, YMD=YMD, ext=ext)
+        if path is None:
+            return False
+        columns = ['mag_lat', 'mag_ltime', 'charge_channel']
+        missing = get_missing_columns(path, columns)
+        if missing:
+            print(f'dmsp-f{index} {YMD:%Y/%m/%d} skipped : 列がありません {missing}')
+            return False
+        df = read_day(path, columns=columns)
+        return self.add(index, YMD, df)
+
+    # 別のマップを足す. ビンが同じで、同じ日を含まないこと
+    def merge(self, other : 'Occurrence_Map') -> None:
+        if not (np.array_equal(self.lat_edges, other.lat_edges) and np.array_equal(self.mlt_edges, other.mlt_edges)):
+            raise ValueError('ビンが違うマップは足せません')
+        overlap = self.days & other.days
+        if overlap:
+            raise ValueError(f'同じ日が含まれています: {sorted(overlap)[:5]}')
+        for key, value in other.counts.items():
+            if key in self.counts:
+                self.counts[key] = self.counts[key] + value
+            else:
+                self.counts[key] = value.copy()
+        self.days |= other.days
+
+    # 条件に合う配列の和. Noneの条件は全てを含む
+    def get_counts(self, index=None, year=None, season : str = None, month=None) -> np.ndarray:
+        """""
+        index, year, month : 整数またはそのリスト, season : SEASONSのキー
+        返り値 : (3, 緯度のビン数, 地方時のビン数)の配列. 順番はCOUNT_NAMES
+        """""
+        conditions = [index, year, month if season is None else SEASONS[season]]
+        conditions = [None if c is None else set(np.atleast_1d(c).tolist()) for c in conditions]
+        output = np.zeros(self.shape, dtype=np.int64)
+        for key, value in self.counts.items():
+            if all(c is None or k in c for k, c in zip(key, conditions)):
+                output += value
+        return output
+
+    # 発生頻度（帯電している秒数 / 滞在秒数）. 滞在していないビンはnan
+    def get_rate(self, index=None, year=None, season : str = None, month=None) -> np.ndarray:
+        dwell, charge, _ = self.get_counts(index=index, year=year, season=season, month=month)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(dwell > 0, charge / dwell, np.nan)
+
+    # 発生頻度を極座標で表示
+    def plot_rate(self, index=None, year=None, season : str = None, month=None):
+        rate = self.get_rate(index=index, year=year, season=season, month=month)
+        theta = self.mlt_edges / 24 * 2 * np.pi
+        ax = plt.subplot(111, projection='polar')
+        mesh = ax.pcolormesh(theta, self.lat_edges, rate)
+        ax.set_ylim([90, self.lat_edges[0]])
+        ax.set_theta_zero_location('S')
+        plt.colorbar(mesh, ax=ax)
+        return ax
+
+    # 圧縮して保存
+    def save(self, path : str = OCCURRENCE_PATH) -> None:
+        keys = sorted(self.counts)
+        # 1か月分の秒数はint32に収まる
+        counts = np.zeros((len(keys),) + self.shape, dtype=np.int32)
+        for i, key in enumerate(keys):
+            counts[i] = self.counts[key]
+        days = sorted(self.days)
+        tmp_path = path + '.tmp.npz'
+        np.savez_compressed(
+            tmp_path,
+            lat_edges=self.lat_edges,
+            mlt_edges=self.mlt_edges,
+            keys=np.array(keys, dtype=np.int32).reshape(-1, 3),
+            counts=counts,
+            day_index=np.array([d[0] for d in days], dtype=np.int32),
+            day_date=np.array([d[1] for d in days], dtype='U8'),
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path : str = OCCURRENCE_PATH) -> 'Occurrence_Map':
+        with np.load(path) as f:
+            occurrence = cls()
+            occurrence.lat_edges = f['lat_edges']
+            occurrence.mlt_edges = f['mlt_edges']
+            occurrence.shape = (len(COUNT_NAMES), len(occurrence.lat_edges) - 1, len(occurrence.mlt_edges) - 1)
+            occurrence.counts = {tuple(key) : value.astype(np.int64) for key, value in zip(f['keys'].tolist(), f['counts'])}
+            occurrence.days = set(zip(f['day_index'].tolist(), f['day_date'].tolist()))
+        return occurrence
+
+
+# 衛星の1年分のマップを作る. プロセスプールから呼ぶ
+def build_year(index : int, year : int, ext : str = COLUMN_EXTENSION, skip : set = None) -> Occurrence_Map:
+    occurrence = Occurrence_Map()
+    skip = skip or set()
+    for YMD in get_days(datetime(year, 1, 1), datetime(year, 12, 31)):
+        if (index, YMD.strftime('%Y%m%d')) not in skip:
+            occurrence.add_day(index, YMD, ext=ext)
+    return occurrence
+
+# 既存のマップに、まだ追加していない日を年ごとに並列で追加して保存
+def main(index_list : list, start_year : int, end_year : int, ext : str = COLUMN_EXTENSION,
+         path : str = OCCURRENCE_PATH, workers : int = None) -> Occurrence_Map:
+    occurrence = Occurrence_Map.load(path) if os.path.exists(path) else Occurrence_Map()
+    jobs = [(index, year) for index in index_list for year in range(start_year, end_year + 1)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for index, year in jobs:
+            skip = {day for day in occurrence.days if day[0] == index and day[1][:4] == str(year)}
+            futures.append(executor.submit(build_year, index, year, ext, skip))
+        for (index, year), future in zip(jobs, futures):
+            result = future.result()
+            occurrence.merge(result)
+            print(f'dmsp-f{index} {year} {len(result.days)} days')
+    occurrence.save(path)
+    return occurrence
+
+if __name__ == '__main__':
+    main(index_list=[16, 17, 18], start_year=2004, end_year=2022)
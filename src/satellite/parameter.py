@@ -5,6 +5,9 @@ class Sat_Config:
     https://www.ncei.noaa.gov/data/dmsp-space-weather-sensors/doc/AFRL%20ASCII%20and%20Binary%20File%20Format%20Descriptions.pdf
     このpdfを参照
     """""
+    # 流量変換テーブルのキャッシュ. key = (衛星番号, 粒子の種類)
+    flux_table_cache = {}
+
     def __init__(self) -> None:
         
         self.channel = [ 30000, 20400, 13900, 9450, 6460, 4400, 3000,\
@@ -195,4 +198,21 @@ class Sat_Config:
         elif spicies == 'electron':
             return self.electron_gfactor_dict[index], dt
 
+    # 16bitの生データを流量に変換するテーブル. shape = (65536, チャンネル数)
+    def get_flux_table(self, index : int, spicies : str) -> np.ndarray:
+        key = (index, spicies)
+        if key not in self.flux_table_cache:
+            gfactor, delta_t = self.get(index=index, spicies=spicies)
+            gfactor = np.array(gfactor, dtype=float)
+            channel = np.array(self.channel, dtype=float)
 
+            energy = np.arange(2**16)[:, None]
+            X = energy % 32
+            Y = (energy - X) / 32
+            with np.errstate(over='ignore'):
+                count = (X + 32) * 2**Y - 33
+                converted_value = count / delta_t / gfactor * channel
+            table = np.where(count > 0, converted_value, 0.0)
+            table.flags.writeable = False
+            self.flux_table_cache[key] = table
+        return self.flux_table_cache[key]
@@ -0,0 +1,60 @@
+# 生データのデコード → 帯電の検知 → 1分ごとの集計 を1回で処理する
+# 1秒ごとのデータは必要な時だけ列指向フォーマットで保存する
+import os
+from datetime import datetime
+from typing import Iterator
+
+import pandas as pd
+
+from .aggregate import aggregate_minute_chunks
+from .charge import SAT_Charge
+from .executor import run_days
+from .preprocess import Process_Binary_File
+from .storage import Column_Writer, get_processed_path, save_columns
+
+# 1分ごとの集計結果の拡張子
+MINUTE_EXTENSION = '_minute.col'
+
+
+# チャンクを書き込みながらそのまま次の処理に渡す
+def write_chunks(chunks : Iterator[pd.DataFrame], writer : Column_Writer) -> Iterator[pd.DataFrame]:
+    for df in chunks:
+        writer.write(df)
+        yield df
+
+# 1日分の生データから1分ごとの集計結果を作る
+def run_day(index : int, YMD : datetime, save : bool = False, chunk_min : int = 60) -> pd.DataFrame:
+    """""
+    index : 衛星番号, YMD : 日にち
+    save : Trueの場合は帯電チャンネルを追加した1秒ごとのデータも保存する
+    返り値 : indexがdate, 列が lat, lon, charge_count などの特徴量（aggregate_minuteを参照）のDataFrame
+    """""
+    pbf = Process_Binary_File()
+    sat = SAT_Charge()
+
+    path = pbf.find_raw_path(YMD=YMD, index=index)
+    if not os.path.isfile(path):
+        raise FileNotFoundError(path)
+
+    chunks = sat.iter_charge_col(pbf.iter_chunks(path=path, YMD=YMD, index=index, chunk_min=chunk_min))
+    if not save:
+        return aggregate_minute_chunks(chunks)
+
+    with Column_Writer(get_processed_path(index=index, YMD=YMD)) as writer:
+        return aggregate_minute_chunks(write_chunks(chunks, writer))
+
+# 1日分を処理して1秒ごとのデータと1分ごとの集計結果を保存
+def process_day(index : int, YMD : datetime) -> None:
+    minute_df = run_day(index=index, YMD=YMD, save=True)
+    save_columns(minute_df.reset_index(), get_processed_path(index=index, YMD=YMD, ext=MINUTE_EXTENSION))
+
+def main(index : int, start_year : int, end_year : int, workers : int = None):
+    start = datetime(year=start_year, month=1, day=1)
+    end = datetime(year=end_year, month=12, day=31)
+    return run_days(process_day, index=index, start=start, end=end, workers=workers)
+
+if __name__ == '__main__':
+    index = 16
+    start_year = 2004
+    end_year = 2004
+    main(index=index, start_year=start_year, end_year=end_year)
@@ -1,31 +1,35 @@
+import gzip
 import os
 from datetime import datetime, timedelta
+from typing import Iterator
 
 import numpy as np
 import pandas as pd
 
+from .executor import run_days
 from .parameter import Sat_Config
+from .storage import get_processed_path, save_columns
 
 
 class Process_Binary_File(Sat_Config):
     def __init__(self) -> None:
+        super().__init__()
         self.DELTA_MIN = 2640
         self.DELTA_SEC = 43
+        # 0をまたぐ列と周期. lon, geo_lon, mag_lon は360度, mag_ltime は24時間
+        self.PERIODIC_COLUMNS = {1 : 360.0, 3 : 360.0, 5 : 360.0, 6 : 24.0}
 
-        self.Sat_Conf = Sat_Config()
-        self.channel_lis = self.Sat_Conf.channel
+        self.channel_lis = self.channel
 
 
-    # バイナリーファイルを読み込む
-    def read_binary_file(self, path : str) -> list:
-        self.data = []
-        with open(path, mode='rb') as f:
-            while True:
-                bytes=f.read(2)
-                if bytes:
-                    self.data.append(int.from_bytes(bytes,byteorder='big'))
-                else:
-                    break
+    # バイナリーファイルを読み込む（ビッグエンディアンの16bit整数の配列）. .gzはメモリ上で解凍する
+    def read_binary_file(self, path : str) -> None:
+        if path.endswith('.gz'):
+            with gzip.open(path, mode='rb') as f:
+                data = np.frombuffer(f.read(), dtype='>u2')
+        else:
+            data = np.fromfile(path, dtype='>u2')
+        self.data = data.astype(np.int64)
 
     # lat, geo_lat, mag_lat全ての緯度に使える
     def get_latitude(self, lat : float) -> float:
@@ -39,6 +43,14 @@ class Process_Binary_File(Sat_Config):
         return float(lon)/10.0
 
 
+    # get_latitudeの配列版
+    def get_latitude_array(self, lat : np.ndarray) -> np.ndarray:
+        return np.where(lat < 1800, (lat - 900) / 10.0, (lat - 4995) / 10.0)
+
+    # get_longitudeの配列版
+    def get_longitude_array(self, lon : np.ndarray) -> np.ndarray:
+        return lon / 10.0
+
     # チャンネルを昇順に並び替える
     def rearrange_channel(self, input : list) -> list:
         output = []
@@ -54,7 +66,7 @@ class Process_Binary_File(Sat_Config):
     # エネルギー流量に変換
     def calculate_flux(self, energy_lis : list, index : int, spicies : str) -> list:
         
-        gfactor, delta_t = self.Sat_Conf.get(index=index, spicies=spicies)
+        gfactor, delta_t = self.get(index=index, spicies=spicies)
 
         output = []
         for energy, g, ch in zip(energy_lis, gfactor, self.channel_lis):
@@ -68,6 +80,11 @@ class Process_Binary_File(Sat_Config):
             output.append(converted_value)
         return output
     
+    # calculate_fluxの配列版. 変換テーブルから一括で取り出す. energyの最後の軸がチャンネル
+    def calculate_flux_array(self, energy : np.ndarray, index : int, spicies : str) -> np.ndarray:
+        table = self.get_flux_table(index=index, spicies=spicies)
+        return table[energy, np.arange(table.shape[1])]
+
     # 3種類の緯度経度を取得
     def get_lat_lon(self, index : int):
         lat = self.get_latitude(self.data[index + 5]) # 測地学的緯度
@@ -88,10 +105,127 @@ class Process_Binary_File(Sat_Config):
         return np.array([lat, lon, geo_lat, geo_lon, mag_lat, mag_lon, mag_ltime])
 
 
+    # 列名を定義
+    def get_columns(self) -> list:
+        columns = ['date', 'lat', 'lon', 'geo_lat', 'geo_lon', 'mag_lat', 'mag_lon', 'mag_ltime']
+
+        chanels = self.channel_lis + self.channel_lis
+
+        for i, ch in enumerate(chanels):
+            if i < len(self.channel_lis):
+                spicies = 'electron'
+            else:
+                spicies = 'ion'
+            columns.append(f'{spicies}_{ch}eV')
+        return columns
+
+    # 1分ごとのレコードに分割. shape = (分数, DELTA_MIN)
+    def split_minutes(self, data : np.ndarray) -> np.ndarray:
+        n_min = len(data) // self.DELTA_MIN
+        return data[:n_min * self.DELTA_MIN].reshape(n_min, self.DELTA_MIN)
+
+    # 全ての分の3種類の緯度経度を取得. shape = (分数, 7)
+    def get_lat_lon_array(self, minutes : np.ndarray) -> np.ndarray:
+        minutes = minutes[:, :15].astype(np.int64)
+        lat = self.get_latitude_array(minutes[:, 5]) # 測地学的緯度
+        lon = self.get_longitude_array(minutes[:, 6]) # 測地学的経度
+
+        geo_lat = self.get_latitude_array(minutes[:, 8]) # 地理座標系の緯度
+        geo_lon = self.get_longitude_array(minutes[:, 9]) # 地理座標系の経度
+
+        mag_lat = self.get_latitude_array(minutes[:, 10]) # 地磁気緯度
+        mag_lon = self.get_longitude_array(minutes[:, 11]) # 地磁気経度
+
+        # 地磁気現地時間
+        mag_ltime = minutes[:, 12] + minutes[:, 13] / 60 + minutes[:, 14] / 3600
+
+        return np.stack([lat, lon, geo_lat, geo_lon, mag_lat, mag_lon, mag_ltime], axis=1)
+
+    # 各分の最初のレコードの時刻（0時からの秒数）
+    def get_minute_time(self, minutes : np.ndarray) -> np.ndarray:
+        minutes = minutes[:, 15:18].astype(np.int64)
+        return minutes[:, 0] * 3600 + minutes[:, 1] * 60 + minutes[:, 2] // 1000
+
+    # 1秒間の緯度経度の変化量. shape = (分数, 7)
+    def get_delta_lat_lon(self, minutes : np.ndarray, last_delta : np.ndarray = None) -> np.ndarray:
+        """
+        last_delta : minutesより前の最後の変化量. 1日の一部だけを変換する時に、先頭の欠損の外挿に使う
+        """
+        latlon_array = self.get_lat_lon_array(minutes)
+        diff = latlon_array[1:] - latlon_array[:-1]
+        # 経度, 地磁気現地時間は0をまたぐ時に1周期分ずらす
+        for col, period in self.PERIODIC_COLUMNS.items():
+            diff[:, col] = np.where(diff[:, col] > period / 2, diff[:, col] - period, diff[:, col])
+            diff[:, col] = np.where(diff[:, col] < -period / 2, diff[:, col] + period, diff[:, col])
+
+        # 次の分が1分後にある時だけ補間する
+        gap = np.diff(self.get_minute_time(minutes))
+        has_next = np.append(np.abs(gap - 60) <= 2, False)
+
+        delta_latlon_array = np.zeros_like(latlon_array)
+        delta_latlon_array[:-1] = diff / 60
+        # 最後の1分と欠損の直前の分は、直前の変化量で外挿する（直前もなければlast_delta, それもなければ変化なし）
+        fallback = np.zeros(latlon_array.shape[1]) if last_delta is None else last_delta
+        source = np.maximum.accumulate(np.where(has_next, np.arange(len(has_next)), -1))
+        delta_latlon_array[~has_next] = np.where(source[~has_next, None] >= 0, delta_latlon_array[source[~has_next]], fallback)
+        return delta_latlon_array
+
+    # 1秒ごとの緯度経度を線形補間. shape = (分数 * 60, 7)
+    def interpolate_lat_lon(self, latlon_array : np.ndarray, delta_latlon_array : np.ndarray) -> np.ndarray:
+        j = np.arange(60, dtype=float)[None, :, None]
+        current_latlon = latlon_array[:, None, :] + delta_latlon_array[:, None, :] * j
+        current_latlon = current_latlon.reshape(-1, latlon_array.shape[1])
+        # 0をまたいだ値を周期の範囲に戻す
+        for col, period in self.PERIODIC_COLUMNS.items():
+            current_latlon[:, col] %= period
+        return current_latlon
+
+    # 1分ごとのレコードを列ごとの配列に変換
+    def decode_minutes(self, minutes : np.ndarray, YMD : datetime, index : int, delta_latlon_array : np.ndarray = None) -> dict:
+        """
+        delta_latlon_array : 1秒間の緯度経度の変化量. 1日の一部だけを変換する時に前後の分から計算して渡す
+        """
+        # 1秒ごとのレコード. shape = (分数, 60, DELTA_SEC)
+        records = minutes[:, 15:15 + 60 * self.DELTA_SEC].reshape(-1, 60, self.DELTA_SEC)
+        records = records.reshape(-1, self.DELTA_SEC)
+
+        # 時間
+        second = records[:, 0] * 3600 + records[:, 1] * 60 + records[:, 2] // 1000
+        date = np.datetime64(YMD, 'ns') + second.astype('timedelta64[s]')
+
+        # 緯度、経度
+        latlon_array = self.get_lat_lon_array(minutes)
+        if delta_latlon_array is None:
+            delta_latlon_array = self.get_delta_lat_lon(minutes)
+        current_latlon = self.interpolate_lat_lon(latlon_array, delta_latlon_array)
+
+        # センサ値（チャンネルを昇順に並び替える）
+        order = np.array(self.rearrange_channel(list(range(20))))
+        electrons = records[:, 3 + order]
+        ions = records[:, 23 + order]
+
+        # 流量
+        ele_flux = self.calculate_flux_array(energy=electrons, index=index, spicies='electron')
+        ion_flux = self.calculate_flux_array(energy=ions, index=index, spicies='ion')
+
+        values = [date] + list(current_latlon.T) + list(ele_flux.T) + list(ion_flux.T)
+        return dict(zip(self.get_columns(), values))
+
     def convert_DataFrame(self, YMD : datetime, index : int):
         """
         YMD : datetime(year, month, day)
         """
+        minutes = self.split_minutes(self.data)
+        return pd.DataFrame(self.decode_minutes(minutes=minutes, YMD=YMD, index=index))
+
+    # 1行ずつ処理する旧実装. convert_DataFrameとの比較用
+    def convert_DataFrame_loop(self, YMD : datetime, index : int):
+        """
+        YMD : datetime(year, month, day)
+        """
+        # 旧実装はPythonのintのリストを前提にしている
+        if isinstance(self.data, np.ndarray):
+            self.data = self.data.tolist()
 
         output = []
         length = len(self.data)
@@ -134,56 +268,109 @@ class Process_Binary_File(Sat_Config):
                 tmp.extend(ion_flux)
                 output.append(tmp)
         
-        # 列名を定義
-        columns = ['date', 'lat', 'lon', 'geo_lat', 'geo_lon', 'mag_lat', 'mag_lon', 'mag_ltime']
-
-        chanels = self.channel_lis + self.channel_lis
+        return pd.DataFrame(output, columns=self.get_columns())
+    
+    # 生データのパス
+    def get_raw_path(self, YMD : datetime, index : int) -> str:
+        year = YMD.year
+        month = str(YMD.month).zfill(2)
+        day = str(YMD.day).zfill(2)
+        return f'/Volumes/USB/Raw_Data/dmsp-f{index}/{year}/{month}/dmsp-f{index}_{year}{month}{day}'
 
-        for i, ch in enumerate(chanels):
-            if i < len(self.channel_lis):
-                spicies = 'electron'
-            else:
-                spicies = 'ion'
-            columns.append(f'{spicies}_{ch}eV')
-        
+    # 解凍済みのファイルがなければ.gzのファイルを使う
+    def find_raw_path(self, YMD : datetime, index : int) -> str:
+        path = self.get_raw_path(YMD=YMD, index=index)
+        if not os.path.isfile(path) and os.path.isfile(path + '.gz'):
+            return path + '.gz'
+        return path
 
-        return pd.DataFrame(output, columns=columns)
-    
     def execute(self, YMD : datetime, index : int):
         """""
         YMD : 検索する日にち、 index : 衛星番号
         """""
-        year = YMD.year
-        month = str(YMD.month).zfill(2)
-        day = str(YMD.day).zfill(2)
-        
-        path = f'/Volumes/USB/Raw_Data/dmsp-f{index}/{year}/{month}/dmsp-f{index}_{year}{month}{day}'
+        path = self.find_raw_path(YMD=YMD, index=index)
 
         self.read_binary_file(path=path)
         df = self.convert_DataFrame(YMD=YMD, index=index)
         return df
 
-def main(index : int, start_year : int, end_year : int):
-    pbf = Process_Binary_File()
-    for year in range(start_year, end_year+1):
-        for month in range(1, 13):
-            for day in range(1, 32):
-                print(year, month, day)
-                try:
-                    YMD = datetime(year=year, month=month, day=day)
-                    df = pbf.execute(YMD=YMD, index=index)
-                except:
-                    continue
-
-                month_str = str(month).zfill(2)
-                day_str = str(day).zfill(2)
-                save_dir = f'/Volumes/USB/Processed_Data/dmsp-f{index}/{year}/{month_str}/'
-                save_file = f'dmsp-f{index}_{year}{month_str}{day_str}.csv'
-
-                 # ディレクトリー作成
-                if not os.path.isdir(save_dir):
-                    os.makedirs(save_dir)
-                df.to_csv(save_dir + save_file, index=False)
+    # chunk_min分ずつ1分ごとのレコードを読み込む. 通常のファイルはメモリマップ, .gzは少しずつ解凍する
+    def iter_minutes(self, path : str, chunk_min : int = 60) -> Iterator[np.ndarray]:
+        if path.endswith('.gz'):
+            with gzip.open(path, mode='rb') as f:
+                while True:
+                    data = np.frombuffer(f.read(chunk_min * self.DELTA_MIN * 2), dtype='>u2')
+                    minutes = self.split_minutes(data)
+                    if len(minutes) == 0:
+                        break
+                    yield minutes.astype(np.int64)
+        else:
+            # 空のファイルはメモリマップできないので読み込まない
+            n_min = os.path.getsize(path) // 2 // self.DELTA_MIN
+            if n_min == 0:
+                return
+            minutes = np.memmap(path, dtype='>u2', mode='r', shape=(n_min, self.DELTA_MIN))
+            for st in range(0, len(minutes), chunk_min):
+                yield minutes[st:st + chunk_min].astype(np.int64)
+
+    # 次のチャンクの先頭の1分を補間に使って、チャンクの1秒間の緯度経度の変化量を求める
+    def get_chunk_delta(self, chunk : np.ndarray, next_minute : np.ndarray, last_delta : np.ndarray = None) -> np.ndarray:
+        """
+        last_delta : 前のチャンクの最後の分の変化量. 欠損の前の外挿をチャンクをまたいで続ける
+        """
+        minutes = np.concatenate([chunk, next_minute])
+        return self.get_delta_lat_lon(minutes, last_delta=last_delta)[:len(chunk)]
+
+    # 変化量を求めたチャンクをデコードする
+    def decode_chunk(self, chunk : np.ndarray, delta_latlon_array : np.ndarray, YMD : datetime, index : int) -> pd.DataFrame:
+        return pd.DataFrame(self.decode_minutes(minutes=chunk, YMD=YMD, index=index, delta_latlon_array=delta_latlon_array))
+
+    # chunk_min分ずつデコードしたDataFrameを返すジェネレーター. 連結するとconvert_DataFrameの結果と同じになる
+    def iter_chunks(self, path : str, YMD : datetime, index : int, chunk_min : int = 60) -> Iterator[pd.DataFrame]:
+        chunk = None
+        last_delta = None
+        # 補間に次のチャンクの先頭の座標を使うため、1チャンク先まで読み込んでからデコードする
+        for next_chunk in self.iter_minutes(path=path, chunk_min=chunk_min):
+            if chunk is not None:
+                delta_latlon_array = self.get_chunk_delta(chunk=chunk, next_minute=next_chunk[:1], last_delta=last_delta)
+                yield self.decode_chunk(chunk=chunk, delta_latlon_array=delta_latlon_array, YMD=YMD, index=index)
+                # 最後の分の変化量は、その分までで最後に求まった変化量（外挿した値を含む）
+                last_delta = delta_latlon_array[-1]
+            chunk = next_chunk
+
+        if chunk is not None:
+            delta_latlon_array = self.get_chunk_delta(chunk=chunk, next_minute=chunk[:0], last_delta=last_delta)
+            yield self.decode_chunk(chunk=chunk, delta_latlon_array=delta_latlon_array, YMD=YMD, index=index)
+
+    # 複数日を連結してchunk_min分ずつデコードする. ファイルがない日は飛ばす
+    def iter_range(self, index : int, start : datetime, end : datetime, chunk_min : int = 60) -> Iterator[pd.DataFrame]:
+        """""
+        start, end : 期間（endの日も含む）
+        """""
+        for YMD in pd.date_range(start, end, freq='D').to_pydatetime():
+            path = self.find_raw_path(YMD=YMD, index=index)
+            if not os.path.isfile(path):
+                continue
+            yield from self.iter_chunks(path=path, YMD=YMD, index=index, chunk_min=chunk_min)
+
+
+# チャンクを順にcsvに書き込む
+def save_csv_chunks(chunks : Iterator[pd.DataFrame], save_path : str) -> None:
+    for i, df in enumerate(chunks):
+        if i == 0:
+            df.to_csv(save_path, index=False)
+        else:
+            df.to_csv(save_path, index=False, mode='a', header=False)
+
+# 1日分の生データを変換して列指向フォーマットで保存（衛星/年/月で分割）
+def process_day(index : int, YMD : datetime) -> None:
+    df = Process_Binary_File().execute(YMD=YMD, index=index)
+    save_columns(df, get_processed_path(index=index, YMD=YMD))
+
+def main(index : int, start_year : int, end_year : int, workers : int = None):
+    start = datetime(year=start_year, month=1, day=1)
+    end = datetime(year=end_year, month=12, day=31)
+    return run_days(process_day, index=index, start=start, end=end, workers=workers)
 
 if __name__ == '__main__':
     index = 16
@@ -41,7 +41,8 @@ def decompress(path : str):
     subprocess.run(cmd)
 
 # cdfデータがないdmspデータを取得する
-def scrape_dmsp(name : str, st_year : int, et_year : int):
+# preprocessは.gzのまま読み込めるので、unzip=Trueの時だけ解凍する
+def scrape_dmsp(name : str, st_year : int, et_year : int, unzip : bool = False):
     for year in range(st_year, et_year):
         y = str(year)
         for month in range(1, 13):
@@ -64,7 +65,8 @@ def scrape_dmsp(name : str, st_year : int, et_year : int):
                 try:
                     urllib.request.urlretrieve(path, save_dir+file_name)
                     # 解凍
-                    decompress(save_dir+file_name)
+                    if unzip:
+                        decompress(save_dir+file_name)
                 except:
                     print(f'{file_name}の保存に失敗しました。')
                     continue
@@ -0,0 +1,185 @@
+# 処理済みデータの列指向フォーマット
+# 1日分を1つのディレクトリー（拡張子 .col）にまとめ、列ごとに.npyファイルで保存する
+# /Volumes/USB/Processed_Data/dmsp-f16/2004/01/dmsp-f16_20040101.col/
+#     columns.json        列の順番
+#     date.npy            datetime64[ns]
+#     lat.npy ...         float32
+#     charge_channel.npy  int8
+# 1分ごとの集計結果は dmsp-f16_20040101_minute.col に同じ形式で保存する
+import json
+import os
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+PROCESSED_DIR = '/Volumes/USB/Processed_Data'
+COLUMN_EXTENSION = '.col'
+# 以前の処理済みデータの拡張子. 列指向フォーマットに変換していない日はこちらを読む
+CSV_EXTENSION = '.csv'
+COLUMNS_FILE = 'columns.json'
+# 追記用に.npyのヘッダーの長さを固定する（マジックナンバーを含めて128バイト）
+HEADER_LENGTH = 128
+
+# 列ごとの型. ここにない列はfloat32
+COLUMN_DTYPE = {
+    'id' : np.int64,
+    'satellite_id' : np.int16,
+    'date' : 'datetime64[ns]',
+    'charge_channel' : np.int8,
+    'charge_count' : np.int16,
+}
+
+
+# 処理済みデータのパス（衛星/年/月で分割）
+def get_processed_path(index : int, YMD : datetime, ext : str = COLUMN_EXTENSION, root : str = PROCESSED_DIR) -> str:
+    year = YMD.year
+    month = str(YMD.month).zfill(2)
+    day = str(YMD.day).zfill(2)
+    return f'{root}/dmsp-f{index}/{year}/{month}/dmsp-f{index}_{year}{month}{day}{ext}'
+
+# 存在する処理済みデータのパス. extのファイルがなければcsvを探し、どちらもなければNone
+def find_processed_path(index : int, YMD : datetime, ext : str = COLUMN_EXTENSION, root : str = PROCESSED_DIR) -> str:
+    for extension in dict.fromkeys([ext, CSV_EXTENSION]):
+        path = get_processed_path(index=index, YMD=YMD, ext=extension, root=root)
+        if os.path.exists(path):
+            return path
+    return None
+
+# 列を保存する型に変換
+def to_column_dtype(name : str, values : np.ndarray) -> np.ndarray:
+    return np.asarray(values).astype(COLUMN_DTYPE.get(name, np.float32))
+
+# 列の順番を読み込む
+def read_column_names(path : str) -> list:
+    with open(os.path.join(path, COLUMNS_FILE)) as f:
+        return json.load(f)
+
+# 列の順番を書き込む
+def write_column_names(path : str, columns : list) -> None:
+    tmp_path = os.path.join(path, COLUMNS_FILE + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(columns, f)
+    os.replace(tmp_path, os.path.join(path, COLUMNS_FILE))
+
+# 1列を書き込む. 書き込み途中のファイルが残らないように一時ファイルから置き換える
+def write_column(path : str, name : str, values : np.ndarray) -> None:
+    tmp_path = os.path.join(path, name + '.tmp.npy')
+    np.save(tmp_path, to_column_dtype(name, values))
+    os.replace(tmp_path, os.path.join(path, name + '.npy'))
+
+# DataFrameを列指向フォーマットで保存
+def save_columns(df : pd.DataFrame, path : str) -> None:
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in df.columns:
+        write_column(path, name, df[name].values)
+    write_column_names(path, list(df.columns))
+
+# 列指向フォーマットを読み込む. columnsを指定するとその列のファイルだけを読む
+def load_columns(path : str, columns : list = None, mmap : bool = False) -> pd.DataFrame:
+    if columns is None:
+        columns = read_column_names(path)
+    mmap_mode = 'r' if mmap else None
+    output = {}
+    for name in columns:
+        output[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode)
+    return pd.DataFrame(output, columns=columns)
+
+# 既存のデータに1列だけ追加（上書き）する
+def add_column(path : str, name : str, values : np.ndarray) -> None:
+    columns = read_column_names(path)
+    write_column(path, name, values)
+    if name not in columns:
+        columns.append(name)
+        write_column_names(path, columns)
+
+# .npyのヘッダー. 後から行数を書き換えられるように長さを固定する
+def make_npy_header(dtype : np.dtype, length : int) -> bytes:
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (np.lib.format.dtype_to_descr(dtype), length)
+    header = header.ljust(HEADER_LENGTH - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1')
+
+
+# チャンクを順に列指向フォーマットに書き込む. 1日分を全てメモリに載せずに保存できる
+class Column_Writer():
+
+    def __init__(self, path : str) -> None:
+        self.path = path
+        self.columns = None
+        self.files = {}
+        self.dtypes = {}
+        self.length = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def write(self, df : pd.DataFrame) -> None:
+        if self.columns is None:
+            self.columns = list(df.columns)
+            for name in self.columns:
+                self.dtypes[name] = to_column_dtype(name, df[name].values[:0]).dtype
+                self.files[name] = open(os.path.join(self.path, name + '.tmp.npy'), 'wb')
+                self.files[name].write(make_npy_header(self.dtypes[name], 0))
+        for name in self.columns:
+            self.files[name].write(np.ascontiguousarray(to_column_dtype(name, df[name].values)).tobytes())
+        self.length += len(df)
+
+    # ヘッダーに行数を書き込んで確定する
+    def close(self) -> None:
+        for name, f in self.files.items():
+            f.seek(0)
+            f.write(make_npy_header(self.dtypes[name], self.length))
+            f.close()
+            os.replace(os.path.join(self.path, name + '.tmp.npy'), os.path.join(self.path, name + '.npy'))
+        if self.columns is not None:
+            write_column_names(self.path, self.columns)
+
+    # 書き込みを中断して一時ファイルを削除する
+    def abort(self) -> None:
+        for name, f in self.files.items():
+            f.close()
+            os.remove(os.path.join(self.path, name + '.tmp.npy'))
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+# チャンクを順に列指向フォーマットで保存
+def save_columns_chunks(chunks, path : str) -> None:
+    with Column_Writer(path) as writer:
+        for df in chunks:
+            writer.write(df)
+
+# 処理済みの1日分のデータにない列. csvはヘッダー, 列指向フォーマットは.npyファイルの有無で調べる
+def get_missing_columns(path : str, columns : list) -> list:
+    _, extension = os.path.splitext(path)
+    if extension == COLUMN_EXTENSION:
+        return [name for name in columns if not os.path.isfile(os.path.join(path, name + '.npy'))]
+    header = pd.read_csv(path, nrows=0).columns
+    return [name for name in columns if name not in header]
+
+# 処理済みの1日分のデータを読み込む. csvと列指向フォーマットの両方に対応
+def read_day(path : str, columns : list = None) -> pd.DataFrame:
+    _, extension = os.path.splitext(path)
+    if extension == COLUMN_EXTENSION:
+        return load_columns(path, columns=columns)
+    elif extension == CSV_EXTENSION:
+        # 読み込む列にdateがない場合はparse_datesに指定できない
+        parse_dates = ['date'] if columns is None or 'date' in columns else False
+        df = pd.read_csv(path, usecols=columns, parse_dates=parse_dates)
+        return df if columns is None else df[columns]
+    raise ValueError(f'対応していない拡張子です: {path}')
+
+# csvを列指向フォーマットに変換
+def convert_csv(csv_path : str, remove : bool = False) -> str:
+    path = os.path.splitext(csv_path)[0] + COLUMN_EXTENSION
+    save_columns(pd.read_csv(csv_path, parse_dates=['date']), path)
+    if remove:
+        os.remove(csv_path)
+    return path
@@ -0,0 +1,102 @@
+# ベンチマーク・検証用の擬似データ
+# Process_Binary_Fileが読み込む生データと同じ形式（1分 = 2640 words, 1秒 = 43 words）で1日分を作る
+# 帯電している時間にはSAT_Charge.detect_chargeが検知する信号を入れる
+import numpy as np
+
+from .preprocess import Process_Binary_File
+
+
+class Synthetic_Data(Process_Binary_File):
+
+    def __init__(self, seed : int = 0) -> None:
+        super().__init__()
+        self.rng = np.random.default_rng(seed)
+        # 生データの20チャンネルのうち、並び替え後の各チャンネルの位置
+        self.order = np.array(self.rearrange_channel(list(range(20))))
+
+    # 流量を16bitの生データに変換（get_flux_tableの逆変換）
+    def encode_flux(self, flux : np.ndarray, index : int, spicies : str) -> np.ndarray:
+        table = self.get_flux_table(index=index, spicies=spicies)[:1024]
+        code = np.zeros(flux.shape, dtype=np.int64)
+        for ch in range(table.shape[1]):
+            code[..., ch] = np.searchsorted(table[:, ch], flux[..., ch]).clip(0, len(table) - 1)
+        return code
+
+    # 緯度を生データに変換（get_latitudeの逆変換）
+    def encode_latitude(self, lat : np.ndarray) -> np.ndarray:
+        return np.round(np.clip(lat, -89.9, 89.9) * 10).astype(np.int64) + 900
+
+    # 経度を生データに変換（get_longitudeの逆変換）
+    def encode_longitude(self, lon : np.ndarray) -> np.ndarray:
+        return np.round(lon * 10).astype(np.int64) % 3600
+
+    # 1分ごとのヘッダーの座標. 約101分で1周する極軌道
+    def make_header(self, n_min : int) -> np.ndarray:
+        t = np.arange(n_min, dtype=float)
+        phase = 2 * np.pi * t / 101
+        lat = 85 * np.sin(phase)
+        lon = (t * 360 / 101 - t * 0.25) % 360
+        mag_lat = 80 * np.sin(phase + 0.1)
+        mag_lon = (lon + 70) % 360
+        mag_ltime = (6 + 12 * (np.cos(phase) < 0) + 2 * np.sin(phase)) % 24
+
+        header = np.zeros((n_min, 15), dtype=np.int64)
+        header[:, 5] = self.encode_latitude(lat)
+        header[:, 6] = self.encode_longitude(lon)
+        header[:, 8] = self.encode_latitude(lat)
+        header[:, 9] = self.encode_longitude(lon)
+        header[:, 10] = self.encode_latitude(mag_lat)
+        header[:, 11] = self.encode_longitude(mag_lon)
+        header[:, 12] = np.floor(mag_ltime)
+        header[:, 13] = np.floor(mag_ltime * 60) % 60
+        header[:, 14] = np.floor(mag_ltime * 3600) % 60
+        return header
+
+    # 帯電している行とチャンネルを決める. 地磁気緯度60度以上の時間からevents回選ぶ
+    def make_events(self, mag_lat : np.ndarray, events : int) -> list:
+        candidate = np.flatnonzero(np.abs(mag_lat) > 60)
+        charge_id = []
+        for st in np.sort(self.rng.choice(candidate, size=events, replace=False)):
+            length = self.rng.integers(5, 60)
+            ch = self.rng.integers(7, 16)
+            charge_id.extend((i, ch) for i in range(st, min(st + length, len(mag_lat))))
+        # 重なった区間は後の帯電チャンネルで上書きする
+        return sorted(dict(charge_id).items())
+
+    def make_day(self, index : int = 16, n_min : int = 1440, events : int = 20) -> tuple:
+        """""
+        index : 衛星番号, n_min : 分数, events : 帯電の回数
+        返り値 : (生データ（ビッグエンディアンの16bit整数の配列）, 帯電している(行, チャンネル)のリスト)
+        """""
+        n_sec = n_min * 60
+        data = np.zeros((n_min, self.DELTA_MIN), dtype=np.int64)
+        data[:, :15] = self.make_header(n_min)
+
+        # 時刻. ミリ秒には1秒未満のずれを入れる
+        second = np.arange(n_sec)
+        records = np.zeros((n_sec, self.DELTA_SEC), dtype=np.int64)
+        records[:, 0] = second // 3600
+        records[:, 1] = second // 60 % 60
+        records[:, 2] = second % 60 * 1000 + self.rng.integers(0, 1000, n_sec)
+
+        # 帯電していない時の流量
+        electron = 10 ** self.rng.uniform(5, 7.5, (n_sec, len(self.channel)))
+        ion = 10 ** self.rng.uniform(4, 6, (n_sec, len(self.channel)))
+
+        # 帯電している時の流量. 高エネルギーのエレクトロンが多く、イオンの1チャンネルが突出する
+        mag_lat = self.get_latitude_array(np.repeat(data[:, 10], 60))
+        charge_id = self.make_events(mag_lat, events)
+        for i, ch in charge_id:
+            electron[i, :3] = 10 ** self.rng.uniform(8.5, 9.5, 3)
+            ion[i, ch] = 10 ** self.rng.uniform(8, 9)
+
+        records[:, 3 + self.order] = self.encode_flux(electron, index=index, spicies='electron')
+        records[:, 23 + self.order] = self.encode_flux(ion, index=index, spicies='ion')
+        data[:, 15:15 + 60 * self.DELTA_SEC] = records.reshape(n_min, -1)
+        return data.reshape(-1).astype('>u2'), charge_id
+
+    # 擬似データをファイルに保存
+    def save_day(self, path : str, index : int = 16, n_min : int = 1440, events : int = 20) -> list:
+        data, charge_id = self.make_day(index=index, n_min=n_min, events=events)
+        data.tofile(path)
+        return charge_id